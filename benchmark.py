@@ -0,0 +1,362 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import optim
+
+import numpy as np
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import optparse
+import contextlib
+
+import train_f
+import gen_fin
+from export import export_sess
+from train_f import Event_Seqce, ControlSeq, Work_w_Dataset, search_files
+
+
+def measure(fn, repeat=5, warmup=1, min_time=0.2):
+    # Seconds per call, the best of repeat rounds; a round calls fn until
+    # min_time has passed, so short calls are not lost in timer noise.
+    for _ in range(warmup):
+        fn()
+    best = float('inf')
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / calls)
+    return best
+
+
+def result(value, unit, better='higher'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+@contextlib.contextmanager
+def num_threads(threads):
+    old = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(old)
+
+
+def bench_representation(data_path, repeat):
+    pairs = [torch.load(path, weights_only=False)  # pickled numpy arrays
+             for path in sorted(search_files(data_path, ['.data']))]
+    assert pairs, f'no .data files under {data_path}'
+    arrays = [np.asarray(events) for events, _ in pairs]
+    compressed = [np.asarray(controls) for _, controls in pairs]
+    n_events = sum(len(a) for a in arrays)
+    results = {}
+
+    seconds = measure(lambda: [Event_Seqce.take_from_array(a) for a in arrays],
+                      repeat)
+    results['take_from_array'] = result(n_events / seconds, 'events/s')
+
+    event_seqs = [Event_Seqce.take_from_array(a) for a in arrays]
+    seconds = measure(lambda: [Event_Seqce.take_from_array(a).conv2note_seq()
+                               for a in arrays], repeat)
+    results['conv2note_seq'] = result(n_events / seconds, 'events/s')
+
+    # conv2array of a sequence built from notes, not a cached index array
+    note_seqs = [seq.conv2note_seq() for seq in event_seqs]
+    built = [Event_Seqce.take_from_note_seq(seq) for seq in note_seqs]
+    n_built = sum(len(seq.events) for seq in built)
+    seconds = measure(lambda: [seq.conv2array() for seq in built], repeat)
+    results['conv2array'] = result(n_built / seconds, 'events/s')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f'{i}.mid') for i in range(len(arrays))]
+        seconds = measure(lambda: [train_f.event_indec2midi_file(a, path)
+                                   for a, path in zip(arrays, paths)], repeat)
+    results['event_indec2midi_file'] = result(n_events / seconds, 'events/s')
+
+    n_steps = sum(len(c) for c in compressed)
+    seconds = measure(lambda: [ControlSeq.recover_compressed_array(c)
+                               for c in compressed], repeat)
+    results['recover_compressed_array'] = result(n_steps / seconds, 'steps/s')
+    return results
+
+
+def bench_dataset(data_path, batch_size, window_size, n_batches, repeat):
+    results = {}
+    seconds = measure(lambda: Work_w_Dataset(data_path), repeat, warmup=0)
+    results['dataset_load'] = result(seconds * 1e3, 'ms', 'lower')
+
+    dataset = Work_w_Dataset(data_path)
+    stride_size = train_f.train['stride_size']
+
+    def take():
+        batches = dataset.batches(batch_size, window_size, stride_size,
+                                  rng=np.random.RandomState(0))
+        for _ in zip(range(n_batches), batches):
+            pass
+    seconds = measure(take, repeat)
+    results['batches'] = result(n_batches / seconds, 'batches/s')
+    return results
+
+
+def bench_model(batch_sizes, thread_counts, steps, repeat):
+    # generation as gen_fin.py runs it for a float session, Step_Engine
+    results = {}
+    torch.manual_seed(0)
+    model = gen_fin.Model_RNN(**gen_fin.model).to(gen_fin.device).eval()
+
+    with torch.no_grad():
+        hidden = model.initialise2hidden(torch.randn(1, model.init_dim))
+        event = model.simple_event(1)
+        seconds = measure(lambda: [model.forw(event, None, hidden)
+                                   for _ in range(100)], repeat)
+    results['forw_latency_b1'] = result(seconds / 100 * 1e3, 'ms', 'lower')
+
+    for threads in thread_counts:
+        with num_threads(threads):
+            for batch_size in batch_sizes:
+                init = torch.randn(batch_size, model.init_dim)
+                engine = gen_fin.Step_Engine(model, batch_size)
+                seconds = measure(lambda: engine.gen_samples(init, steps),
+                                  repeat)
+                key = f'step_engine_b{batch_size}_t{threads}'
+                results[key] = result(batch_size * steps / seconds, 'events/s')
+    return results
+
+
+def bench_training(data_path, batch_size, window_size, iterations):
+    # train_f.py's step on the forwards it runs: the teacher forced one of
+    # the default loop and forw_carried of --stateful
+    np.random.seed(0)
+    torch.manual_seed(0)
+    dataset = Work_w_Dataset(data_path)
+    model = train_f.Model_RNN(**train_f.model_config).to(train_f.device)
+    optimizer = optim.Adam(model.parameters(), lr=train_f.train['learning_rate'])
+    batches = dataset.batches(batch_size, window_size,
+                              train_f.train['stride_size'],
+                              rng=np.random.RandomState(0))
+    stateful_batches = dataset.stateful_batches(batch_size, window_size,
+                                                rng=np.random.RandomState(0))
+    carried = {'hidden': None, 'prev_event': None}
+
+    def teacher_forced(events, controls, init):
+        inputs = torch.cat([model.simple_event(batch_size), events[:-1]], 0)
+        outputs, _ = model.forw_teacher_forced(inputs, controls,
+                                               model.initialise2hidden(init))
+        return outputs
+
+    def stateful(events, controls, init, resets):
+        outputs, carried['hidden'] = model.forw_carried(
+            init, events, controls, carried['hidden'], carried['prev_event'],
+            resets)
+        carried['prev_event'] = events[-1]
+        return outputs
+
+    def step(batches, forward):
+        events, controls, *resets = next(batches)
+        events = torch.as_tensor(events, dtype=torch.long)
+        controls = torch.as_tensor(controls, dtype=torch.float32)
+        init = torch.randn(batch_size, model.init_dim)
+        outputs = forward(events, controls, init, *resets)
+        loss = F.cross_entropy(outputs.float().view(-1, train_f.event_dim),
+                               events.view(-1))
+        model.zero_grad()
+        loss.backward()
+        nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+
+    results = {}
+    seconds = measure(lambda: step(batches, teacher_forced), iterations)
+    results[f'train_b{batch_size}_w{window_size}'] = result(1 / seconds, 'it/s')
+    seconds = measure(lambda: step(stateful_batches, stateful), iterations)
+    results[f'train_stateful_b{batch_size}_w{window_size}'] = \
+        result(1 / seconds, 'it/s')
+    return results
+
+
+def bench_startup(repeat):
+    # gen_fin.py run as a one-off command on a training session and on its
+    # export.py file; time to first file counts from process start
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'gen_fin.py')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        torch.manual_seed(0)
+        model = train_f.Model_RNN(**train_f.model_config)
+        optimizer = optim.Adam(model.parameters())
+        for param in model.parameters():
+            param.grad = torch.zeros_like(param)
+        optimizer.step()  # so the session carries the Adam state
+        sess_path = os.path.join(tmp, 'train.sess')
+        torch.save({'model_config': train_f.model_config,
+                    'model_state': model.state_dict(),
+                    'model_optimizer_state': optimizer.state_dict()}, sess_path)
+        infer_path = os.path.join(tmp, 'train.infer.sess')
+        export_sess(sess_path, infer_path)
+
+        log_path = os.path.join(tmp, 'log.jsonl')
+        for name, path in [('sess', sess_path), ('export', infer_path)]:
+            times, loads = [], []
+            for _ in range(repeat):
+                subprocess.run([sys.executable, script, '-s', path, '-b', '1',
+                                '-l', '50', '-o', os.path.join(tmp, 'out'),
+                                '--log', log_path],
+                               check=True, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+                with open(log_path) as f:
+                    record = json.loads(f.readlines()[-1])
+                times.append(record['first_file'])
+                loads.append(record['phases']['load'])
+            results[f'first_file_{name}'] = result(min(times), 's', 'lower')
+            results[f'load_{name}'] = result(min(loads) * 1e3, 'ms', 'lower')
+    return results
+
+
+def compare(results, baseline, max_regression):
+    # -> names of results worse than the baseline by more than max_regression
+    regressions = []
+    # printed to stderr, stdout may be carrying the json
+    out = sys.stderr
+    print(f'{"benchmark":32}{"baseline":>14}{"current":>14}{"change":>9}',
+          file=out)
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], current['value']
+        speedup = new / old if current['better'] == 'higher' else old / new
+        mark = ''
+        if speedup < 1 - max_regression:
+            regressions.append(name)
+            mark = '  REGRESSION'
+        print(f'{name:32}{old:14.4g}{new:14.4g}{(speedup - 1) * 100:+8.1f}%'
+              f'{mark}', file=out)
+    return regressions
+
+
+def getopt():
+    parser = optparse.OptionParser()
+
+    parser.add_option('-d',
+                      dest='data_path',
+                      type='string',
+                      default='test_train/')
+
+    parser.add_option('-o',
+                      dest='output_path',
+                      type='string',
+                      default=None,
+                      help='write the results as json here (default: stdout)')
+
+    parser.add_option('--baseline',
+                      dest='baseline_path',
+                      type='string',
+                      default=None,
+                      help='json from an earlier run to compare with')
+
+    parser.add_option('--max-regression',
+                      dest='max_regression',
+                      type='float',
+                      default=0.2,
+                      help='slowdown that counts as a regression, exit status '
+                           '1 if any (default 0.2)')
+
+    parser.add_option('--only',
+                      dest='only',
+                      type='string',
+                      default='representation,dataset,model,training,startup',
+                      help='comma separated groups to run')
+
+    parser.add_option('-b',
+                      dest='batch_sizes',
+                      type='string',
+                      default='1,8,64',
+                      help='Step_Engine batch sizes')
+
+    parser.add_option('-t',
+                      dest='thread_counts',
+                      type='string',
+                      default=f'1,{os.cpu_count()}',
+                      help='Step_Engine torch thread counts')
+
+    parser.add_option('-l',
+                      dest='steps',
+                      type='int',
+                      default=100,
+                      help='Step_Engine steps')
+
+    parser.add_option('--train-batch',
+                      dest='train_batch',
+                      type='int',
+                      default=16)
+
+    parser.add_option('--train-window',
+                      dest='train_window',
+                      type='int',
+                      default=100)
+
+    parser.add_option('-r',
+                      dest='repeat',
+                      type='int',
+                      default=5)
+
+    return parser.parse_args()[0]
+
+
+if __name__ == '__main__':
+    opt = getopt()
+    groups = opt.only.split(',')
+    results = {}
+    if 'representation' in groups:
+        results.update(bench_representation(opt.data_path, opt.repeat))
+    if 'dataset' in groups:
+        results.update(bench_dataset(opt.data_path, opt.train_batch,
+                                     opt.train_window, 50, opt.repeat))
+    if 'model' in groups:
+        batch_sizes = [int(b) for b in opt.batch_sizes.split(',')]
+        thread_counts = sorted({int(t) for t in opt.thread_counts.split(',')})
+        results.update(bench_model(batch_sizes, thread_counts, opt.steps,
+                                   opt.repeat))
+    if 'training' in groups:
+        results.update(bench_training(opt.data_path, opt.train_batch,
+                                      opt.train_window, opt.repeat))
+    if 'startup' in groups:
+        results.update(bench_startup(opt.repeat))
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'threads': torch.get_num_threads(),
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if opt.output_path:
+        with open(opt.output_path, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if opt.baseline_path:
+        with open(opt.baseline_path) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, opt.max_regression)
+        if regressions:
+            print(f'{len(regressions)} regression(s):', ', '.join(regressions),
+                  file=sys.stderr)
+            sys.exit(1)
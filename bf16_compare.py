@@ -0,0 +1,150 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import optim
+
+import numpy as np
+
+import time
+import optparse
+
+import train_f
+import gen_fin
+from quantize import next_event_divergence, load_control_files
+
+device = train_f.device
+
+
+def train_run(dataset, bf16, iterations, batch_size, window_size, stride_size,
+              seed=0, warmup=3):
+    # Same steps as train_f.py's default loop, from the same seed and the
+    # same batches -> model, per-iteration losses, iterations/sec
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    model = train_f.Model_RNN(**train_f.model_config).to(device)
+    optimizer = optim.Adam(model.parameters(),
+                           lr=train_f.train['learning_rate'])
+    batches = dataset.batches(batch_size, window_size, stride_size,
+                              rng=np.random.RandomState(seed))
+    losses = []
+    for iteration, (events, controls) in zip(range(iterations), batches):
+        if iteration == warmup:
+            start = time.time()
+        events = torch.as_tensor(events, dtype=torch.long).to(device)
+        controls = torch.as_tensor(controls, dtype=torch.float32).to(device)
+        init = torch.randn(batch_size, model.init_dim).to(device)
+        with torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16):
+            outputs = model.gen_samples(init, window_size, events=events[:-1],
+                                        controls=controls)
+        loss = F.cross_entropy(outputs.float().view(-1, train_f.event_dim),
+                               events.view(-1))
+        model.zero_grad()
+        loss.backward()
+        nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+        losses.append(loss.item())
+    return model, losses, (iterations - warmup) / (time.time() - start)
+
+
+def gen_speed(model, batch_size, steps, seed=0):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    init = torch.randn(batch_size, model.init_dim).to(device)
+    engine = gen_fin.Step_Engine(model, batch_size)
+    engine.gen_samples(init, 10)  # warm up
+    start = time.time()
+    engine.gen_samples(init, steps)
+    return batch_size * steps / (time.time() - start)
+
+
+def getopt():
+    parser = optparse.OptionParser()
+
+    parser.add_option('-d',
+                      dest='data_path',
+                      type='string',
+                      default='test_train/')
+
+    parser.add_option('-i',
+                      dest='iterations',
+                      type='int',
+                      default=100)
+
+    parser.add_option('-b',
+                      dest='batch_size',
+                      type='int',
+                      default=16)
+
+    parser.add_option('-w',
+                      dest='window_size',
+                      type='int',
+                      default=100)
+
+    parser.add_option('--every',
+                      dest='every',
+                      type='int',
+                      default=10,
+                      help='iterations averaged per line of the loss curve')
+
+    parser.add_option('-l',
+                      dest='steps',
+                      type='int',
+                      default=300,
+                      help='generation steps for events/sec and divergence')
+
+    parser.add_option('--gen-batch',
+                      dest='gen_batch',
+                      type='string',
+                      default='1,8,64')
+
+    parser.add_option('--seed',
+                      dest='seed',
+                      type='int',
+                      default=0)
+
+    return parser.parse_args()[0]
+
+
+if __name__ == '__main__':
+    opt = getopt()
+    dataset = train_f.Work_w_Dataset(opt.data_path)
+    stride_size = train_f.train['stride_size']
+
+    runs = {}
+    for name, bf16 in [('fp32', False), ('bf16', True)]:
+        runs[name] = train_run(dataset, bf16, opt.iterations, opt.batch_size,
+                               opt.window_size, stride_size, opt.seed)
+
+    print('=' * 80)
+    print(f'training, batch {opt.batch_size}, window {opt.window_size}')
+    print(f'{"iter":>8}{"fp32 loss":>12}{"bf16 loss":>12}')
+    for i in range(0, opt.iterations, opt.every):
+        print(f'{i:8}', end='')
+        for name in runs:
+            print(f'{np.mean(runs[name][1][i:i + opt.every]):12.4f}', end='')
+        print()
+    print(f'{"it/s":>8}', end='')
+    for name in runs:
+        print(f'{runs[name][2]:12.2f}', end='')
+    print()
+
+    # generation with the fp32-trained weights, as gen_fin.py --bf16 does
+    model = runs['fp32'][0].cpu()
+    fp32 = gen_fin.Model_RNN(**train_f.model_config).to(device)
+    fp32.load_state_dict(model.state_dict())
+    fp32.eval()
+    bf16 = gen_fin.Model_RNN(**train_f.model_config).to(device)
+    bf16.load_state_dict(model.state_dict())
+    bf16 = bf16.to(torch.bfloat16).eval()
+
+    print('=' * 80)
+    batch_sizes = [int(b) for b in opt.gen_batch.split(',')]
+    print(f'{"":8}' + ''.join(f'{f"ev/s b={b}":>12}' for b in batch_sizes))
+    for name, model in [('fp32', fp32), ('bf16', bf16)]:
+        speeds = [gen_speed(model, b, opt.steps, opt.seed) for b in batch_sizes]
+        print(f'{name:8}' + ''.join(f'{speed:12.0f}' for speed in speeds))
+
+    events, controls, _ = load_control_files(opt.data_path, opt.steps)
+    kl, agree = next_event_divergence([fp32, bf16], events, controls, opt.seed)
+    print(f'next event, fp32 vs bf16: mean KL {kl.mean():.5f}, '
+          f'max KL {kl.max():.5f}, argmax agree {agree.mean():.3f}')
@@ -0,0 +1,78 @@
+import torch
+
+import numpy as np
+
+import os
+import time
+import optparse
+
+from train_f import Model_RNN, Work_w_Dataset, evaluate, device
+
+
+def load_sess(sess_path):
+    state = torch.load(sess_path, map_location='cpu')
+    model = Model_RNN(**state['model_config']).to(device)
+    model.load_state_dict(state['model_state'])
+    return model
+
+
+def getopt():
+    parser = optparse.OptionParser(usage='%prog [options] SESS...')
+
+    parser.add_option('-d',
+                      dest='data_path',
+                      type='string',
+                      default='dataset/processed/')
+
+    parser.add_option('--valid-ratio',
+                      dest='valid_ratio',
+                      type='float',
+                      default=0.05,
+                      help='the same split train_f.py --valid-ratio holds out; '
+                           '0 evaluates every sample')
+
+    parser.add_option('-b',
+                      dest='batch_size',
+                      type='int',
+                      default=256)
+
+    parser.add_option('-w',
+                      dest='window_size',
+                      type='int',
+                      default=200)
+
+    parser.add_option('--max-events',
+                      dest='max_events',
+                      type='int',
+                      default=0,
+                      help='read only about this many events, a fixed subset '
+                           'of windows spread over the samples (0 = all)')
+
+    parser.add_option('--carry',
+                      dest='carry',
+                      action='store_true',
+                      default=False,
+                      help='read every sample whole instead of in '
+                           'independent windows')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt, sess_paths = getopt()
+    assert sess_paths, 'no session files given'
+    dataset = Work_w_Dataset(opt.data_path)
+    if opt.valid_ratio:
+        sample_ids = dataset.valid_split(opt.valid_ratio)
+    else:
+        sample_ids = np.arange(len(dataset.seqlens))
+    print(f'{len(sample_ids)} samples, {dataset.seqlens[sample_ids].sum()} events')
+
+    for sess_path in sess_paths:
+        assert os.path.isfile(sess_path), f'"{sess_path}" is not a file'
+        model = load_sess(sess_path)
+        start = time.time()
+        loss, n_events = evaluate(model, dataset, sample_ids, opt.batch_size,
+                                  opt.window_size, opt.carry, opt.max_events)
+        print(f'{sess_path}: loss {loss:.4f}, perplexity {np.exp(loss):.2f} '
+              f'({time.time() - start:.1f}s)')
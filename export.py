@@ -0,0 +1,46 @@
+import torch
+
+import os
+import optparse
+
+
+def export_sess(sess_path, save_path):
+    # Training session -> file with only the model config and weights.
+    # It holds plain tensors, so gen_fin.load_model can open it weights-only
+    # and memory mapped; the optimizer and training state are left out.
+    state = torch.load(sess_path, map_location='cpu', weights_only=False)
+    assert not state.get('quantized'), \
+        'int8 sessions can not be loaded weights-only, export the fp32 one'
+    model_state = {name: tensor.detach().contiguous().clone()
+                   for name, tensor in state['model_state'].items()}
+    torch.save({'model_config': state['model_config'],
+                'model_state': model_state}, save_path)
+
+
+def getopt():
+    parser = optparse.OptionParser()
+
+    parser.add_option('-s',
+                      dest='sess_path',
+                      type='string',
+                      default='save/train.sess')
+
+    parser.add_option('-o',
+                      dest='output_path',
+                      type='string',
+                      default=None,
+                      help='where to save the inference file '
+                           '(default: next to -s with .infer.sess)')
+
+    return parser.parse_args()[0]
+
+
+if __name__ == '__main__':
+    opt = getopt()
+    assert os.path.isfile(opt.sess_path), f'"{opt.sess_path}" is not a file'
+    output_path = opt.output_path or \
+                  os.path.splitext(opt.sess_path)[0] + '.infer.sess'
+
+    export_sess(opt.sess_path, output_path)
+    print(f'Saved {output_path} ({os.path.getsize(output_path) / 2**20:.1f}MB, '
+          f'session {os.path.getsize(opt.sess_path) / 2**20:.1f}MB)')
@@ -10,8 +10,14 @@ import sys
 import time
 import optparse
 
-import copy, itertools, collections
-from pretty_midi import PrettyMIDI, Note, Instrument
+import copy, itertools, collections, struct, heapq, pickle, hashlib, fnmatch, re
+from concurrent.futures import ThreadPoolExecutor
+
+from timing import Phase_Timer, Metrics_Log, make_profiler, phase_summary, \
+                   peak_rss_bytes, process_seconds
+
+# pretty_midi, progress and midi2audio are imported where they are used,
+# generating and writing midi files needs none of them
 
 STATE_RESOLUTION = 220
 STATE_TEMP = 120
@@ -42,6 +48,7 @@ class Note_Seqce:
         return copy.deepcopy(self)
 
     def convert2midi(self):
+        from pretty_midi import PrettyMIDI, Instrument
         midi = PrettyMIDI(resolution=STATE_RESOLUTION, initial_tempo=STATE_TEMP)
         inst = Instrument(1, False, 'Note_Seqce')
         inst.notes = copy.deepcopy(self.notes)
@@ -80,18 +87,32 @@ class Event_Seqce:
     
     @staticmethod
     def take_from_array(event_indeces):
-        time = 0
-        events = []
-        for event_index in event_indeces:
-            for event_type, feat_range in Event_Seqce.featur_ranges().items():
-                if feat_range.start <= event_index < feat_range.stop:
-                    event_value = event_index - feat_range.start
-                    events.append(Event(event_type, time, event_value))
-                    if event_type == 'time_shift':
-                        time += Event_Seqce.time_shift_bins[event_value]
-                    break
+        return Event_Seqce.take_from_batch(np.asarray(event_indeces)[None])[0]
 
-        return Event_Seqce(events)
+    @staticmethod
+    def take_from_batch(event_indeces):
+        # [batch, steps] -> list of Event_Seqce, decoded in one pass
+        event_indeces = np.asarray(event_indeces)
+        types, values, times = Event_Seqce.decode_array(event_indeces)
+        event_seqs = []
+        for i in range(event_indeces.shape[0]):
+            event_seq = Event_Seqce()
+            event_seq._events = None
+            event_seq._indeces = event_indeces[i]
+            event_seq._decoded = (types[i], values[i], times[i])
+            event_seqs.append(event_seq)
+        return event_seqs
+
+    @staticmethod
+    def decode_array(event_indeces):
+        # [..., steps] -> types, values, times with the same shape
+        event_indeces = np.asarray(event_indeces, dtype=np.int64)
+        types = EVENT_TYPE_TABLE[event_indeces]
+        values = EVENT_VALUE_TABLE[event_indeces]
+        shifts = EVENT_SHIFT_TABLE[event_indeces]
+        times = np.zeros(shifts.shape)
+        np.cumsum(shifts[..., :-1], axis=-1, out=times[..., 1:]) # time before the event
+        return types, values, times
 
     @staticmethod
     def dim():
@@ -124,15 +145,32 @@ class Event_Seqce:
                 n / (Event_Seqce.velocity_steps - 1))
 
     def __init__(self, events=[]):
-        self.events = copy.deepcopy(events)
+        self._events = copy.deepcopy(events)
+        self._indeces = None
+        self._decoded = None
         time = 0
-        for event in self.events:
+        for event in self._events:
             event.time = time
             if event.type == 'time_shift':
                 time += Event_Seqce.time_shift_bins[event.value]
+
+    @property
+    def events(self):
+        if self._events is None:
+            types, values, times = self._decoded
+            self._events = [Event(EVENT_TYPES[t], time, value)
+                            for t, value, time in zip(types.tolist(),
+                                                      values.tolist(),
+                                                      times.tolist())]
+        return self._events
+
+    def decoded(self):
+        if self._decoded is None:
+            self._decoded = Event_Seqce.decode_array(self.conv2array())
+        return self._decoded
     
     def conv2note_seq(self):
-        time = 0
+        from pretty_midi import Note
         notes = []
         
         velocity = STATE_VELOCITY
@@ -140,28 +178,27 @@ class Event_Seqce:
 
         last_notes = {}
 
-        for event in self.events:
-            if event.type == 'note_on':
-                pitch = event.value + Event_Seqce.pitch_range.start
+        types, values, times = self.decoded()
+        for event_type, value, time in zip(types.tolist(), values.tolist(),
+                                           times.tolist()):
+            if event_type == EVENT_NOTE_ON:
+                pitch = value + Event_Seqce.pitch_range.start
                 note = Note(velocity, pitch, time, None)
                 notes.append(note)
                 last_notes[pitch] = note
 
-            elif event.type == 'note_off':
-                pitch = event.value + Event_Seqce.pitch_range.start
+            elif event_type == EVENT_NOTE_OFF:
+                pitch = value + Event_Seqce.pitch_range.start
 
                 if pitch in last_notes:
                     note = last_notes[pitch]
                     note.end = max(time, note.start + MIN_NOTE_LENGTH)
                     del last_notes[pitch]
             
-            elif event.type == 'velocity':
-                index = min(event.value, velocity_bins.size - 1)
+            elif event_type == EVENT_VELOCITY:
+                index = min(value, velocity_bins.size - 1)
                 velocity = velocity_bins[index]
 
-            elif event.type == 'time_shift':
-                time += Event_Seqce.time_shift_bins[event.value]
-
         for note in notes:
             if note.end is None:
                 note.end = note.start + STATE_NOTE_LENGTH
@@ -171,11 +208,26 @@ class Event_Seqce:
         return Note_Seqce(notes)
 
     def conv2array(self):
+        if self._indeces is not None:
+            return self._indeces
         feat_idxs = Event_Seqce.featur_ranges()
         idxs = [feat_idxs[event.type][event.value] for event in self.events]
         dtype = np.uint8 if Event_Seqce.dim() <= 256 else np.uint16
         return np.array(idxs, dtype=dtype)
 
+# Vocabulary lookup tables, built once: event index -> type id, value
+# and the time shift (in seconds) it contributes.
+EVENT_TYPES = list(Event_Seqce.featur_ranges().keys())
+EVENT_NOTE_ON, EVENT_NOTE_OFF, EVENT_VELOCITY, EVENT_TIME_SHIFT = range(4)
+EVENT_TYPE_TABLE = np.concatenate([
+    np.full(len(feat_range), i, dtype=np.int64)
+    for i, feat_range in enumerate(Event_Seqce.featur_ranges().values())])
+EVENT_VALUE_TABLE = np.concatenate([
+    np.arange(len(feat_range), dtype=np.int64)
+    for feat_range in Event_Seqce.featur_ranges().values()])
+EVENT_SHIFT_TABLE = np.zeros(Event_Seqce.dim())
+EVENT_SHIFT_TABLE[Event_Seqce.featur_ranges()['time_shift']] = STATE_TIME_SHIFT_BINS
+
 class Control:
 
     def __init__(self, pitch_histogram, note_density):
@@ -221,33 +273,322 @@ class ControlSeq:
         return featur_ranges
     
     @staticmethod
-    def recover_compressed_array(array):
+    def recover_compressed_array(array, dtype=np.float64):
         featur_dimen = ControlSeq.featur_dimen()
-        ndens = np.zeros([array.shape[0], featur_dimen['note_density']])
-        ndens[np.arange(array.shape[0]), array[:, 0]] = 1. # [steps, dens_dim]
-        phist = array[:, 1:].astype(np.float64) / 255 # [steps, hist_dim]
-        return np.concatenate([ndens, phist], 1) # [steps, dens_dim + hist_dim]
+        ndens = np.eye(featur_dimen['note_density'], dtype=dtype)
+        ndens = ndens[array[..., 0]] # [..., dens_dim]
+        phist = array[..., 1:].astype(dtype) / 255 # [..., hist_dim]
+        return np.concatenate([ndens, phist], -1) # [..., dens_dim + hist_dim]
 
     def __init__(self, controls):
-        for control in controls:
-            self.controls = copy.deepcopy(controls)
+        self.controls = copy.deepcopy(controls)
 
 
 import os
 import numpy as np
 
 
-def event_indec2midi_file(event_indeces, midi_file_name, velocity_scale=0.8):
-    event_seq = Event_Seqce.take_from_array(event_indeces)
-    note_seq = event_seq.conv2note_seq()
-    for note in note_seq.notes:
-        note.velocity = int((note.velocity - 64) * velocity_scale + 64)
-    note_seq.convert2midi_file(midi_file_name)
-    return len(note_seq.notes)
-
-
+def event_indec2note_arrays(decoded, velocity_scale=0.8):
+    # (types, values, times) of one sequence -> pitches, velocities, starts, ends
+    types, values, times = decoded
+    is_on = types == EVENT_NOTE_ON
+    is_off = types == EVENT_NOTE_OFF
+
+    # velocity in effect at each event: last velocity event before it
+    velocity_bins = Event_Seqce.getting_veloc_basket()
+    is_velocity = types == EVENT_VELOCITY
+    last = np.where(is_velocity, np.arange(types.size), -1)
+    last = np.maximum.accumulate(last) if last.size else last
+    velocities = np.where(
+        last >= 0,
+        velocity_bins[np.minimum(values[np.maximum(last, 0)],
+                                 velocity_bins.size - 1)],
+        STATE_VELOCITY)
+
+    # a note_off closes the note_on right before it with the same pitch,
+    # any other note_on/note_off in between leaves the note open
+    positions = np.flatnonzero(is_on | is_off)
+    pitch_order = positions[np.lexsort((positions, values[positions]))]
+    closes = (is_on[pitch_order[:-1]] & is_off[pitch_order[1:]]
+              & (values[pitch_order[:-1]] == values[pitch_order[1:]]))
+    ends = np.full(types.size, np.nan)
+    ends[pitch_order[:-1][closes]] = times[pitch_order[1:][closes]]
+
+    on = np.flatnonzero(is_on)
+    pitches = values[on] + Event_Seqce.pitch_range.start
+    starts = times[on]
+    ends = ends[on]
+    ends = np.where(np.isnan(ends), starts + STATE_NOTE_LENGTH,
+                    np.maximum(ends, starts + MIN_NOTE_LENGTH))
+    velocities = velocities[on].astype(np.int64)
+    velocities = ((velocities - 64) * velocity_scale + 64).astype(np.int64)
+    return pitches, velocities, starts, ends
+
+
+def _smf_varlen(values):
+    # variable-length quantities, [n] ints -> [n, 4] bytes and a mask
+    shifts = np.array([21, 14, 7, 0])
+    lengths = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    data = (values[:, None] >> shifts) & 0x7f
+    data[:, :3] |= 0x80
+    mask = np.arange(4) >= 4 - lengths[:, None]
+    return data, mask
+
+
+def note_arrays2smf(pitches, velocities, starts, ends):
+    # Same layout Note_Seqce.convert2midi().write() produces: a tempo
+    # track and one piano track, note offs as velocity-0 note ons.
+    tick_scale = 60.0 / (STATE_TEMP * STATE_RESOLUTION)
+    n = pitches.size
+    ticks = np.rint(np.concatenate([starts, ends]) / tick_scale).astype(np.int64)
+    notes = np.concatenate([pitches, pitches]).astype(np.int64)
+    vels = np.concatenate([velocities, np.zeros(n, np.int64)])
+    order = np.lexsort((vels, notes, ticks))
+    ticks, notes, vels = ticks[order], notes[order], vels[order]
+
+    deltas = np.diff(ticks, prepend=0)
+    data, mask = _smf_varlen(deltas)
+    status = np.zeros([2 * n, 1], np.int64)
+    status[:1] = 0x90
+    data = np.concatenate([data, status, notes[:, None], vels[:, None]], 1)
+    mask = np.concatenate([mask, status > 0, np.ones([2 * n, 2], bool)], 1)
+    body = data[mask].astype(np.uint8).tobytes()
+
+    tempo = int(6e7 / STATE_TEMP)
+    name = b'Note_Seqce'
+    tempo_track = (b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big')
+                   + b'\x00\xff\x58\x04\x04\x02\x18\x08'
+                   + b'\x01\xff\x2f\x00')
+    note_track = (b'\x00\xff\x03' + bytes([len(name)]) + name
+                  + b'\x00\xc0\x01' + body + b'\x01\xff\x2f\x00')
+
+    chunks = [b'MThd' + struct.pack('>Ihhh', 6, 1, 2, STATE_RESOLUTION)]
+    for track in [tempo_track, note_track]:
+        chunks.append(b'MTrk' + struct.pack('>I', len(track)) + track)
+    return b''.join(chunks)
+
+
+def event_indec2smf(event_indeces, velocity_scale=0.8):
+    # one sequence -> bytes of the midi file
+    decoded = Event_Seqce.decode_array(event_indeces)
+    return note_arrays2smf(*event_indec2note_arrays(decoded, velocity_scale))
+
+
+def event_indec2seconds(event_indeces):
+    # [..., steps] -> seconds of music, the sum of the time shifts
+    return EVENT_SHIFT_TABLE[np.asarray(event_indeces, dtype=np.int64)].sum(-1)
 
 
+def event_indec2midi_file(event_indeces, midi_file_name, velocity_scale=0.8):
+    decoded = Event_Seqce.decode_array(event_indeces)
+    notes = event_indec2note_arrays(decoded, velocity_scale)
+    with open(midi_file_name, 'wb') as f:
+        f.write(note_arrays2smf(*notes))
+    return notes[0].size
+
+
+def event_indec2midi_files(event_indeces, midi_file_names, velocity_scale=0.8,
+                           callback=None, timer=None):
+    # [batch, steps] -> one file per row, decoded in one pass (a list of
+    # rows of different lengths is decoded row by row);
+    # callback(row, midi_file_name) runs as soon as a file is written,
+    # time goes to timer's 'decode' and 'write' phases
+    timer = timer if timer is not None else Phase_Timer()
+    with timer.phase('decode'):
+        if isinstance(event_indeces, list):
+            rows = [Event_Seqce.decode_array(row) for row in event_indeces]
+        else:
+            rows = list(zip(*Event_Seqce.decode_array(event_indeces)))
+    n_notes = []
+    for i, midi_file_name in enumerate(midi_file_names):
+        with timer.phase('decode'):
+            decoded = rows[i]
+            notes = event_indec2note_arrays(decoded, velocity_scale)
+            smf = note_arrays2smf(*notes)
+        with timer.phase('write'):
+            with open(midi_file_name, 'wb') as f:
+                f.write(smf)
+        n_notes.append(notes[0].size)
+        if callback is not None:
+            callback(i, midi_file_name)
+    return n_notes
+
+
+
+
+
+def _varlen_bytes(value):
+    data = [value & 0x7f]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(data))
+
+
+class Note_Stream:
+    # Incremental Event_Seqce.conv2note_seq for one sequence: push events
+    # as they are generated and get back the notes that are finished.
+    # Notes come as (pitch, velocity, start, end) with velocity_scale
+    # already applied, like event_indec2note_arrays.
+
+    def __init__(self, velocity_scale=0.8):
+        self.velocity_scale = velocity_scale
+        self.velocity_bins = Event_Seqce.getting_veloc_basket()
+        self.velocity = STATE_VELOCITY
+        self.time = 0
+        self.open_notes = {} # pitch -> (start, velocity)
+
+    def _note(self, pitch, start, velocity, end):
+        velocity = int((int(velocity) - 64) * self.velocity_scale + 64)
+        return pitch, velocity, start, end
+
+    def push(self, event_indeces):
+        notes = []
+        for index in np.asarray(event_indeces).tolist():
+            event_type, value = EVENT_TYPE_TABLE[index], EVENT_VALUE_TABLE[index]
+            if event_type == EVENT_NOTE_ON:
+                pitch = value + Event_Seqce.pitch_range.start
+                if pitch in self.open_notes:
+                    # replaced before its note_off: it will never be closed
+                    start, velocity = self.open_notes[pitch]
+                    notes.append(self._note(pitch, start, velocity,
+                                            start + STATE_NOTE_LENGTH))
+                self.open_notes[pitch] = (self.time, self.velocity)
+
+            elif event_type == EVENT_NOTE_OFF:
+                pitch = value + Event_Seqce.pitch_range.start
+                if pitch in self.open_notes:
+                    start, velocity = self.open_notes.pop(pitch)
+                    end = max(self.time, start + MIN_NOTE_LENGTH)
+                    notes.append(self._note(pitch, start, velocity, end))
+
+            elif event_type == EVENT_VELOCITY:
+                self.velocity = self.velocity_bins[min(value, self.velocity_bins.size - 1)]
+
+            else:
+                self.time += Event_Seqce.time_shift_bins[value]
+        return notes
+
+    def settled_time(self):
+        # No note finished later starts before this time (open notes are
+        # only handed out once their end is known).
+        return min([self.time] + [start for start, _ in self.open_notes.values()])
+
+    def close(self):
+        notes = [self._note(pitch, start, velocity, start + STATE_NOTE_LENGTH)
+                 for pitch, (start, velocity) in self.open_notes.items()]
+        self.open_notes = {}
+        return notes
+
+
+class Midi_Stream_Writer:
+    # Writes the same file as note_arrays2smf, but note by note: events
+    # are buffered until Note_Stream.settled_time has moved past their
+    # tick, and the track length is patched in on close.
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.tick_scale = 60.0 / (STATE_TEMP * STATE_RESOLUTION)
+        self.pending = [] # heap of (tick, pitch, velocity)
+        self.last_tick = 0
+        self.status = False
+        tempo = int(6e7 / STATE_TEMP)
+        name = b'Note_Seqce'
+        tempo_track = (b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big')
+                       + b'\x00\xff\x58\x04\x04\x02\x18\x08'
+                       + b'\x01\xff\x2f\x00')
+        self.file.write(b'MThd' + struct.pack('>Ihhh', 6, 1, 2, STATE_RESOLUTION))
+        self.file.write(b'MTrk' + struct.pack('>I', len(tempo_track)) + tempo_track)
+        self.file.write(b'MTrk')
+        self.length_pos = self.file.tell()
+        self.file.write(b'\x00\x00\x00\x00')
+        self.track_start = self.file.tell()
+        self.file.write(b'\x00\xff\x03' + bytes([len(name)]) + name + b'\x00\xc0\x01')
+
+    def tick(self, time):
+        return int(round(time / self.tick_scale))
+
+    def add_notes(self, notes):
+        for pitch, velocity, start, end in notes:
+            heapq.heappush(self.pending, (self.tick(start), pitch, velocity))
+            heapq.heappush(self.pending, (self.tick(end), pitch, 0))
+
+    def flush(self, time=None):
+        limit = self.tick(time) if time is not None else None
+        data = bytearray()
+        while self.pending and (limit is None or self.pending[0][0] < limit):
+            tick, pitch, velocity = heapq.heappop(self.pending)
+            data += _varlen_bytes(tick - self.last_tick)
+            if not self.status:
+                data.append(0x90)
+                self.status = True
+            data += bytes([pitch, velocity])
+            self.last_tick = tick
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.write(b'\x01\xff\x2f\x00')
+        length = self.file.tell() - self.track_start
+        self.file.seek(self.length_pos)
+        self.file.write(struct.pack('>I', length))
+        self.file.close()
+
+
+def stream2midi_files(event_chunks, midi_file_names, velocity_scale=0.8,
+                      callback=None):
+    # event_chunks: iterable of [chunk, batch] index arrays (see
+    # Model_RNN.gen_stream). Notes are written as soon as they are
+    # finished; callback(row, notes) sees them too.
+    decoders = [Note_Stream(velocity_scale) for _ in midi_file_names]
+    writers = [Midi_Stream_Writer(path) for path in midi_file_names]
+    try:
+        for chunk in event_chunks:
+            chunk = np.asarray(chunk)
+            for row, (decoder, writer) in enumerate(zip(decoders, writers)):
+                notes = decoder.push(chunk[:, row])
+                writer.add_notes(notes)
+                writer.flush(decoder.settled_time())
+                if callback is not None and notes:
+                    callback(row, notes)
+        for row, (decoder, writer) in enumerate(zip(decoders, writers)):
+            notes = decoder.close()
+            writer.add_notes(notes)
+            if callback is not None and notes:
+                callback(row, notes)
+    finally:
+        for writer in writers:
+            writer.close()
+
+class Audio_Renderer:
+    # Renders midi files to wav with up to `workers` fluidsynth processes
+    # at a time (midi2audio runs one per file, loading the soundfont each
+    # time); the threads only wait on them, and files can be submitted
+    # while the rest of the batch is still being written.
+
+    def __init__(self, font, workers=None):
+        from midi2audio import FluidSynth
+        self.synth = FluidSynth(font)
+        self.pool = ThreadPoolExecutor(workers or os.cpu_count())
+        self.futures = []
+
+    def _render(self, midi_path, wav_path):
+        self.synth.midi_to_audio(midi_path, wav_path)
+        return wav_path
+
+    def submit(self, midi_path, wav_path=None):
+        if wav_path is None:
+            wav_path = os.path.splitext(midi_path)[0] + '.wav'
+        self.futures.append(self.pool.submit(self._render, midi_path, wav_path))
+
+    def close(self):
+        # -> paths of the rendered files, raises if any render failed
+        try:
+            return [future.result() for future in self.futures]
+        finally:
+            self.pool.shutdown()
 
 ## Config
 
@@ -278,7 +619,6 @@ import torch.nn.functional as F
 from torch.distributions import Categorical
 
 import numpy as np
-from progress.bar import Bar
 
 class Model_RNN(nn.Module):
     def __init__(self, event_dim, control_dim, init_dim, hidden_dim,
@@ -314,24 +654,42 @@ class Model_RNN(nn.Module):
         self.output_fc.bias.data.fill_(0.)
 
     def _sample_even(self, output, greedy=True, temperature=1.0):
-        if greedy:
+        # greedy: a bool, or a bool tensor [batch] of one draw per row;
+        # temperature: a float or a tensor [batch]
+        output = output.float()  # softmax in fp32 for bf16 models
+        if torch.is_tensor(greedy) and greedy.all() or \
+           not torch.is_tensor(greedy) and greedy:
             return output.argmax(-1)
-        else:
-            output = output / temperature
-            probs = self.output_fc_activation(output)
-            return Categorical(probs).sample()
-
-    def forw(self, event, control=None, hidden=None):
+        if torch.is_tensor(temperature):
+            temperature = temperature.view(-1, 1)
+        output_scaled = output / temperature
+        probs = self.output_fc_activation(output_scaled)
+        sampled = Categorical(probs).sample()
+        if torch.is_tensor(greedy) and greedy.any():
+            sampled = torch.where(greedy, output.argmax(-1), sampled)
+        return sampled
+
+    def _greedy_draw(self, greedy, batch_size):
+        # greedy: a ratio for the whole batch or one per row
+        if np.ndim(greedy) == 0:
+            return np.random.random() < greedy
+        return torch.from_numpy(np.random.random(batch_size)
+                                < np.asarray(greedy)).to(device)
+
+    def forw(self, event, control=None, hidden=None, default=None):
+        # default: optional [1, batch, 1] flags, 1 for rows without controls
+        # (their control rows should be zeros), for batches mixing both
         batch_size = event.shape[1]
         event = self.event_embedding(event)
 
         if control is None:
             default = torch.ones(1, batch_size, 1).to(device)
             control = torch.zeros(1, batch_size, self.control_dim).to(device)
-        else:
+        elif default is None:
             default = torch.zeros(1, batch_size, 1).to(device)
 
-        concat = torch.cat([event, default, control], -1)
+        dtype = event.dtype  # bfloat16 after model.to(torch.bfloat16)
+        concat = torch.cat([event, default.to(dtype), control.to(dtype)], -1)
         input = self.concat_input_fc(concat)
         input = self.concat_input_fc_activation(input)
 
@@ -346,7 +704,8 @@ class Model_RNN(nn.Module):
     
     def initialise2hidden(self, init):
         batch_size = init.shape[0]
-        out = self.inithid_fc(init)
+        # the embedding keeps the float dtype, int8 linears have no .weight
+        out = self.inithid_fc(init.to(self.event_embedding.weight.dtype))
         out = self.inithid_fc_activation(out)
         out = out.view(self.gru_layers, batch_size, self.hidden_dim)
         return out
@@ -356,48 +715,660 @@ class Model_RNN(nn.Module):
             return controls[:steps]
         return controls.repeat(steps, 1, 1)
     
+    @torch.no_grad()
+    def prefill(self, init, primers, controls=None):
+        # Teacher-forces the primers through the GRU in one packed pass ->
+        # (hidden, event) to continue from with gen_samples(start=...):
+        # the state after each primer and its last event. primers: event
+        # index arrays, one per row, lengths may differ; controls: None or
+        # [steps, batch, control_dim] covering the longest primer.
+        batch_size = len(primers)
+        lengths = torch.tensor([len(primer) for primer in primers])
+        assert lengths.min() > 0, 'empty primer'
+        steps = int(lengths.max())
+
+        # inputs like training: the start event, then each event but the last
+        events = torch.full((steps, batch_size), self.primary_event,
+                            dtype=torch.long)
+        for row, primer in enumerate(primers):
+            events[1:len(primer), row] = torch.as_tensor(
+                np.asarray(primer[:-1], dtype=np.int64))
+        last = torch.tensor([[int(primer[-1]) for primer in primers]])
+        event = self.event_embedding(events.to(device))
+
+        if controls is None:
+            default = torch.ones(steps, batch_size, 1).to(device)
+            controls = torch.zeros(steps, batch_size, self.control_dim).to(device)
+        else:
+            default = torch.zeros(steps, batch_size, 1).to(device)
+            controls = controls[:steps]
+        dtype = event.dtype
+        concat = torch.cat([event, default.to(dtype), controls.to(dtype)], -1)
+        input = self.concat_input_fc(concat)
+        input = self.concat_input_fc_activation(input)
+
+        input = nn.utils.rnn.pack_padded_sequence(input, lengths,
+                                                  enforce_sorted=False)
+        _, hidden = self.gru(input, self.initialise2hidden(init))
+        return hidden, last.to(device)
+
     def gen_samples(self, init, steps, events=None, controls=None, greedy=1.0,
-                 temperature=1.0, teacher_forcing_ratio=1.0):
+                 temperature=1.0, teacher_forcing_ratio=1.0, start=None,
+                 return_state=False, stop=None):
+        # greedy, temperature: one for the batch or one per row;
+        # start: (hidden, event) to continue from, see prefill;
+        # return_state: also return the (hidden, event) to go on from;
+        # stop: a Row_Stop, finished rows leave the batch and their
+        # outputs from there on are zeros
 
         batch_size = init.shape[0]
+        temperature = row_param(temperature)
 
         use_teacher_forcing = events is not None
         if use_teacher_forcing:
             events = events[:steps-1]
 
-        event = self.simple_event(batch_size)
         use_control = controls is not None
         if use_control:
             controls = self.expand_contr(controls, steps)
-        hidden = self.initialise2hidden(init)
+        if start is None:
+            event = self.simple_event(batch_size)
+            hidden = self.initialise2hidden(init)
+        else:
+            hidden, event = start
+
+        if stop is not None:
+            assert not use_teacher_forcing
+            final_hidden, final_event = hidden.clone(), event.clone()
+            rows = torch.as_tensor(stop.active, device=device)
+            hidden, event = hidden[:, rows], event[:, rows]
 
+        from progress.bar import Bar
         outputs = []
         step_iter = range(steps)
         step_iter = Bar('Some_magic').iter(step_iter)
 
         for step in step_iter:
             control = controls[step].unsqueeze(0) if use_control else None
+            use_greedy = self._greedy_draw(greedy, batch_size)
+            row_temperature = temperature
+            if stop is not None:
+                if not len(rows):
+                    break
+                control = control[:, rows] if use_control else None
+                if torch.is_tensor(use_greedy):
+                    use_greedy = use_greedy[rows]
+                if torch.is_tensor(temperature):
+                    row_temperature = temperature[rows]
             output, hidden = self.forw(event, control, hidden)
 
-            use_greedy = np.random.random() < greedy
             event = self._sample_even(output, greedy=use_greedy,
-                                       temperature=temperature)
-
-            outputs.append(event)
+                                       temperature=row_temperature)
+
+            if stop is None:
+                outputs.append(event)
+            else:
+                output = torch.zeros(1, batch_size, dtype=torch.long,
+                                     device=device)
+                output[:, rows] = event
+                outputs.append(output)
+                keep = stop.update(event[0])
+                if keep is not None:
+                    done = torch.as_tensor(np.setdiff1d(np.arange(len(rows)),
+                                                        keep), device=device)
+                    final_hidden[:, rows[done]] = hidden[:, done]
+                    final_event[:, rows[done]] = event[:, done]
+                    keep = torch.as_tensor(keep, device=device)
+                    rows, hidden, event = rows[keep], hidden[:, keep], event[:, keep]
 
             if use_teacher_forcing and step < steps - 1:
                 if np.random.random() <= teacher_forcing_ratio:
                     event = events[step].unsqueeze(0)
         
+        if stop is not None:
+            final_hidden[:, rows], final_event[:, rows] = hidden, event
+            hidden, event = final_hidden, final_event
+            outputs += [torch.zeros(1, batch_size, dtype=torch.long,
+                                    device=device)] * (steps - len(outputs))
+
+        if return_state:
+            return torch.cat(outputs, 0), (hidden, event)
         return torch.cat(outputs, 0)
 
+    def gen_stream(self, init, steps=None, controls=None, greedy=1.0,
+                   temperature=1.0, chunk_size=1, start=None):
+        # Like gen_samples, but yields the sampled events as [chunk, batch]
+        # tensors while generating; steps=None never stops. A control
+        # sequence shorter than the piece keeps its last step.
+        batch_size = init.shape[0]
+        temperature = row_param(temperature)
+        if start is None:
+            event = self.simple_event(batch_size)
+            hidden = self.initialise2hidden(init)
+        else:
+            hidden, event = start
+        chunk = []
+        step_iter = itertools.count() if steps is None else range(steps)
+
+        with torch.no_grad():
+            for step in step_iter:
+                control = None
+                if controls is not None:
+                    control = controls[min(step, controls.shape[0] - 1)].unsqueeze(0)
+                output, hidden = self.forw(event, control, hidden)
+
+                use_greedy = self._greedy_draw(greedy, batch_size)
+                event = self._sample_even(output, greedy=use_greedy,
+                                          temperature=temperature)
+                chunk.append(event)
+                if len(chunk) == chunk_size:
+                    yield torch.cat(chunk, 0)
+                    chunk = []
+        if chunk:
+            yield torch.cat(chunk, 0)
+
+class Row_Stop:
+    # Which rows of a batch still generate, for gen_samples(stop=...): a
+    # row stops after lengths[row] steps or once its time shifts add up to
+    # seconds[row] of music, whichever comes first. Kept across calls, so
+    # a piece generated in segments stops where it would in one.
+
+    def __init__(self, batch_size, lengths, seconds=None):
+        self.lengths = np.array(np.broadcast_to(lengths, batch_size),
+                                dtype=np.int64)
+        self.seconds = None if seconds is None else \
+                       np.array(np.broadcast_to(seconds, batch_size), dtype=float)
+        self.steps = np.zeros(batch_size, np.int64)  # generated so far
+        self.elapsed = np.zeros(batch_size)  # seconds of music so far
+        running = self.lengths > 0
+        if self.seconds is not None:
+            running &= self.seconds > 0
+        self.active = np.flatnonzero(running)
+
+    def update(self, events):
+        # events: this step's events of the running rows, in the order of
+        # self.active -> the positions among them of the rows that go on,
+        # None if all of them do
+        active = self.active
+        self.steps[active] += 1
+        done = self.steps[active] >= self.lengths[active]
+        if self.seconds is not None:
+            self.elapsed[active] += EVENT_SHIFT_TABLE[events.cpu().numpy()]
+            done |= self.elapsed[active] >= self.seconds[active]
+        if not done.any():
+            return None
+        keep = np.flatnonzero(~done)
+        self.active = active[keep]
+        return keep
+
+
+class Step_Engine:
+    # Inference-only gen_samples for a float Model_RNN: the per-step inputs,
+    # logits, probabilities and sampled events live in buffers allocated
+    # once, the layers and the sampling are called through their kernels
+    # with out= or in place, and the greedy draws are taken up front. Only
+    # the GRU kernel, which has no out=, still returns a new hidden state
+    # every step. Same ops in the same order as forw/gen_samples, so a
+    # fixed seed gives the same events.
+    # Works in the model's dtype; sampling always reads fp32 logits. Rows
+    # may have a greedy ratio and temperature each, all rows are still
+    # sampled in one multinomial call per step. Rows that finish leave the
+    # batch, the buffers are then used in part.
+
+    def __init__(self, model, batch_size):
+        self.model = model
+        self.batch_size = batch_size
+        gru = model.gru
+        self.gru_args = (gru._flat_weights, gru.bias, gru.num_layers, 0.0,
+                         False, gru.bidirectional, gru.batch_first)
+        concat_fc, output_fc = model.concat_input_fc, model.output_fc
+        self.concat_weight = concat_fc.weight.t()
+        self.output_weight = output_fc.weight.t()
+        self.concat_bias, self.output_bias = concat_fc.bias, output_fc.bias
+
+        dtype = concat_fc.weight.dtype
+        with torch.inference_mode():
+            empty = lambda *shape, dtype=dtype: torch.empty(*shape, dtype=dtype,
+                                                            device=device)
+            self.concat = empty(batch_size, model.concat_dim)
+            self.embedded = empty(batch_size, model.event_dim)
+            self.input = empty(batch_size, model.input_dim)
+            self.flat_hidden = empty(batch_size, model.gru_layers * model.hidden_dim)
+            self.logits = empty(batch_size, model.output_dim)
+            self.scaled = empty(batch_size, model.output_dim, dtype=torch.float32)
+            self.probs = empty(batch_size, model.output_dim, dtype=torch.float32)
+            self.prob_sum = empty(batch_size, 1, dtype=torch.float32)
+            self.sampled = empty(batch_size, 1, dtype=torch.long)
+            self.greedy_event = empty(batch_size, dtype=torch.long)
+            self.greedy_row = empty(batch_size, dtype=torch.bool)
+            self.event = empty(batch_size, dtype=torch.long)
+
+    def _set_control(self, control, n):
+        # for the first n rows of the buffers
+        event_dim = self.model.event_dim
+        concat = self.concat[:n]
+        if control is None:
+            concat[:, event_dim] = 1
+            concat[:, event_dim + 1:] = 0
+        else:
+            concat[:, event_dim] = 0
+            concat[:, event_dim + 1:].copy_(control)
+
+    @torch.inference_mode()
+    def gen_samples(self, init, steps, controls=None, greedy=1.0,
+                    temperature=1.0, start=None, return_state=False,
+                    stop=None):
+        # -> [steps, batch] events, like Model_RNN.gen_samples; with stop
+        # (a Row_Stop) finished rows leave the batch, the steps after run
+        # on the rows left and the outputs of the finished are zeros
+        model = self.model
+        event_dim = model.event_dim
+        layers, hidden_dim = model.gru_layers, model.hidden_dim
+        batch_size = self.batch_size
+        assert init.shape[0] == batch_size
+
+        outputs = torch.zeros(steps, batch_size, dtype=torch.long, device=device)
+        greedy_rows = None
+        if np.ndim(greedy) == 0:
+            use_greedy = np.random.random(steps) < greedy
+        else:  # [steps, batch]
+            use_greedy = np.random.random((steps, batch_size)) < np.asarray(greedy)
+            greedy_rows = torch.from_numpy(use_greedy).to(device)
+        temperature = row_param(temperature)
+        if torch.is_tensor(temperature):
+            temperature = temperature.view(-1, 1)
+        if start is None:
+            hidden = model.initialise2hidden(init)
+            event = torch.full((batch_size,), model.primary_event,
+                               dtype=torch.long, device=device)
+        else:
+            hidden, event = start
+            event = event.reshape(batch_size)
+
+        rows = None  # the running rows, None while all of them are
+        if stop is not None:
+            final_hidden, final_event = hidden.clone(), event.clone()
+            if len(stop.active) < batch_size:
+                rows = torch.as_tensor(stop.active, device=device)
+                hidden, event = hidden[:, rows], event[rows]
+        n = batch_size if rows is None else len(rows)
+        row_temperature = temperature
+        if rows is not None and torch.is_tensor(temperature):
+            row_temperature = temperature[rows]
+        if controls is not None and controls.shape[0] == 1:
+            self._set_control(controls[0] if rows is None else controls[0][rows], n)
+        elif controls is None:
+            self._set_control(None, n)
+
+        for step in range(steps):
+            if n == 0:
+                break
+            if controls is not None and controls.shape[0] > 1:
+                self._set_control(controls[step] if rows is None
+                                  else controls[step][rows], n)
+            concat, logits = self.concat[:n], self.logits[:n]
+            torch.index_select(model.event_embedding.weight, 0, event,
+                               out=self.embedded[:n])
+            concat[:, :event_dim].copy_(self.embedded[:n])
+            torch.addmm(self.concat_bias, concat, self.concat_weight,
+                        out=self.input[:n])
+            F.leaky_relu_(self.input[:n], 0.1)
+
+            _, hidden = torch._VF.gru(self.input[:n].unsqueeze(0), hidden,
+                                      *self.gru_args)
+            self.flat_hidden[:n].view(n, layers, hidden_dim).copy_(
+                hidden.permute(1, 0, 2))
+            torch.addmm(self.output_bias, self.flat_hidden[:n],
+                        self.output_weight, out=logits)
+
+            draw = use_greedy[step]
+            if rows is not None and greedy_rows is not None:
+                draw = draw[stop.active]
+            event = outputs[step] if rows is None else self.event[:n]
+            if draw.all():
+                torch.argmax(logits, -1, out=event)
+            else:
+                scaled, sampled = self.scaled[:n], self.sampled[:n]
+                probs, prob_sum = self.probs[:n], self.prob_sum[:n]
+                scaled.copy_(logits).div_(row_temperature)
+                torch.softmax(scaled, -1, out=probs)
+                torch.sum(probs, -1, keepdim=True, out=prob_sum)
+                probs.div_(prob_sum)  # as Categorical
+                torch.multinomial(probs, 1, True, out=sampled)
+                if draw.any():  # some rows greedy, some not
+                    greedy_row = self.greedy_row[:n]
+                    if rows is None:
+                        greedy_row.copy_(greedy_rows[step])
+                    else:
+                        torch.index_select(greedy_rows[step], 0, rows,
+                                           out=greedy_row)
+                    torch.argmax(logits, -1, out=self.greedy_event[:n])
+                    torch.where(greedy_row, self.greedy_event[:n],
+                                sampled[:, 0], out=event)
+                else:
+                    event.copy_(sampled[:, 0])
+            if rows is not None:
+                outputs[step, rows] = event
+
+            if stop is not None:
+                keep = stop.update(event)
+                if keep is not None:
+                    running = torch.arange(batch_size, device=device) \
+                              if rows is None else rows
+                    done = torch.as_tensor(np.setdiff1d(np.arange(n), keep),
+                                           device=device)
+                    final_hidden[:, running[done]] = hidden[:, done]
+                    final_event[running[done]] = event[done]
+                    keep = torch.as_tensor(keep, device=device)
+                    rows, hidden, event = running[keep], hidden[:, keep], event[keep]
+                    n = len(rows)
+                    if torch.is_tensor(temperature):
+                        row_temperature = temperature[rows]
+                    if controls is not None and controls.shape[0] == 1:
+                        self._set_control(controls[0][rows], n)
+
+        if stop is not None:
+            running = torch.arange(batch_size, device=device) \
+                      if rows is None else rows
+            final_hidden[:, running], final_event[running] = hidden, event
+            hidden, event = final_hidden, final_event
+        if return_state:
+            return outputs, (hidden, event.unsqueeze(0))
+        return outputs
+
+
+def row_param(value):
+    # a float for the whole batch, or one per row as a float tensor [batch]
+    if np.ndim(value) == 0:
+        return value
+    return torch.as_tensor(np.asarray(value), dtype=torch.float32, device=device)
+
+
+def row_values(text, batch_size, type=float):
+    # '0.8,1.2' -> one value per row, given to the rows in turn; a single
+    # value stays a single value
+    values = [type(value) for value in str(text).split(',')]
+    if len(values) == 1:
+        return values[0]
+    return np.array([values[row % len(values)] for row in range(batch_size)])
+
+
+MIDI_EXTS = ('.mid', '.midi')
+
+
+def control_files(root):
+    # midi and .data files under root, sorted
+    paths = []
+    for path, _, files in os.walk(root):
+        paths.extend(os.path.join(path, name) for name in files
+                     if name.lower().endswith(MIDI_EXTS + ('.data',)))
+    return sorted(paths)
+
+
+def control_cache_key(path):
+    # content hash of the file and the settings the controls depend on
+    key = hashlib.md5()
+    with open(path, 'rb') as f:
+        key.update(f.read())
+    key.update(repr((ControlSeq.window_size,
+                     ControlSeq.note_density_bins.tolist())).encode())
+    return key.hexdigest()
+
+
+def load_compressed_controls(path, cache_dir=None):
+    # .data or midi file -> compressed controls [steps, hist_dim + 1], kept
+    # in cache_dir as <hash>.npy so a file is only read whole once
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, control_cache_key(path) + '.npy')
+        if os.path.isfile(cache_path):
+            return np.load(cache_path)
+
+    if path.lower().endswith(MIDI_EXTS):
+        from preprocess import preprocess_midi  # pretty_midi and train_f
+        data = preprocess_midi(path)
+        assert data is not None, f'"{path}" has no notes'
+        compressed = data[1]
+    else:
+        _, compressed = torch.load(path, map_location='cpu', weights_only=False)
+        compressed = np.asarray(compressed, dtype=np.uint8)
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, compressed)
+        os.replace(tmp_path, cache_path)
+    return compressed
+
+
+def load_control(control, cache_dir=None):
+    # -c value (a .data or midi file or 'histogram;density') ->
+    # [steps, control_dim] float tensor and its description
+    if os.path.isfile(control):
+        compressed_controls = load_compressed_controls(control, cache_dir)
+        controls = ControlSeq.recover_compressed_array(compressed_controls)
+        return torch.tensor(controls, dtype=torch.float32), control
+    return parse_control(control)
+
+
+def parse_control(control):
+    # 'histogram;density' -> [1, control_dim] float tensor and its
+    # description; never opens a file
+    pitch_histogram, note_density = control.split(';')
+    pitch_histogram = list(filter(len, pitch_histogram.split(',')))
+    if len(pitch_histogram) == 0:
+        pitch_histogram = np.ones(12) / 12
+    else:
+        pitch_histogram = np.array(list(map(float, pitch_histogram)))
+        assert pitch_histogram.size == 12
+        assert np.all(pitch_histogram >= 0)
+        pitch_histogram = pitch_histogram / pitch_histogram.sum() \
+                          if pitch_histogram.sum() else np.ones(12) / 12
+    note_density = int(note_density)
+    assert note_density in range(len(ControlSeq.note_density_bins))
+    control = Control(pitch_histogram, note_density)
+    controls = torch.tensor(control.conv2array(), dtype=torch.float32)
+    return controls.unsqueeze(0), repr(control)
+
+
+def load_controls(control, batch_size, cache_dir=None):
+    # Like load_control, for a whole batch -> [steps, batch, control_dim]
+    # and the description of each row. control is one -c value or a list
+    # of them, a directory stands for its files; the rows take them in
+    # turn. Shorter control sequences keep their last step.
+    specs = []
+    for spec in [control] if isinstance(control, str) else control:
+        if os.path.isdir(spec):
+            paths = control_files(spec)
+            assert paths, f'no midi or .data files in "{spec}"'
+            specs.extend(paths)
+        else:
+            specs.append(spec)
+    specs = [specs[row % len(specs)] for row in range(batch_size)]
+    rows = {spec: load_control(spec, cache_dir) for spec in set(specs)}
+    steps = max(len(controls) for controls, _ in rows.values())
+    controls = torch.stack([
+        torch.cat([rows[spec][0],
+                   rows[spec][0][-1:].expand(steps - len(rows[spec][0]), -1)])
+        for spec in specs], 1)
+    return controls, [rows[spec][1] for spec in specs]
+
+
+def load_primer(path):
+    # midi, .data or .npy file -> events [steps] and the compressed
+    # controls [steps, hist_dim + 1] of those events
+    if path.lower().endswith(MIDI_EXTS):
+        from preprocess import preprocess_midi  # pretty_midi and train_f
+        data = preprocess_midi(path)
+        assert data is not None, f'"{path}" has no notes'
+        return data
+    if path.endswith('.npy'):
+        from train_f import Event_Seqce as Seqce, ControlSeq as Controls
+        events = np.load(path)
+        return events, Controls.take_compressed_from_event_seq(
+                           Seqce.take_from_array(events))
+    events, compressed = torch.load(path, map_location='cpu', weights_only=False)
+    return np.asarray(events), np.asarray(compressed, dtype=np.uint8)
+
+
+def load_primers(primer, batch_size, max_len=0):
+    # --primer value (a file or a directory whose files go to the rows in
+    # turn) -> events of each row, their controls [steps, batch,
+    # control_dim] padded with zeros, paths; max_len keeps the last events
+    if os.path.isdir(primer):
+        paths = control_files(primer)
+        assert paths, f'no midi or .data files in "{primer}"'
+    else:
+        paths = [primer]
+    paths = [paths[row % len(paths)] for row in range(batch_size)]
+    loaded = {path: load_primer(path) for path in set(paths)}
+    primers, compressed = [], []
+    for path in paths:
+        events, controls = loaded[path]
+        if max_len:
+            events, controls = events[-max_len:], controls[-max_len:]
+        primers.append(events)
+        compressed.append(controls)
+    steps = max(len(events) for events in primers)
+    controls = np.zeros([steps, batch_size, ControlSeq.dim()], np.float32)
+    for row, rows in enumerate(compressed):
+        controls[:len(rows), row] = ControlSeq.recover_compressed_array(rows)
+    return primers, torch.from_numpy(controls), paths
+
+
+def control_window(controls, start, steps):
+    # controls [steps, batch, control_dim] for steps [start, start + steps)
+    # of the piece, start an int or one per row; a single control step
+    # stays as it is, a sequence that is too short keeps its last step
+    if controls is None or controls.shape[0] == 1:
+        return controls
+    index = torch.as_tensor(start).reshape(1, -1) + torch.arange(steps)[:, None]
+    index = index.clamp(max=controls.shape[0] - 1).to(controls.device)
+    rows = torch.arange(controls.shape[1], device=controls.device)
+    return controls[index, rows]
+
+
+def get_np_state(rng):
+    # numpy RandomState state with the key as a tensor, so snapshots load
+    # with weights_only
+    name, keys, pos, has_gauss, gauss = rng.get_state()
+    return name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, gauss
+
+
+def set_np_state(rng, state):
+    name, keys, pos, has_gauss, gauss = state
+    rng.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss,
+                   gauss))
+
+
+class Snapshot_Store:
+    # Generation snapshots on disk, one <key>.snap per row: the GRU hidden
+    # state [layers, hidden_dim], the event to feed next, the control
+    # cursor (steps generated so far), the events of the piece up to
+    # there and the torch/numpy rng states. Plain tensors and numbers,
+    # so they load weights-only.
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.snap')
+
+    def keys(self, pattern='*'):
+        # matching keys, numbers in them in numeric order (name-2 < name-10)
+        if not os.path.isdir(self.root):
+            return []
+        keys = [name[:-len('.snap')] for name in os.listdir(self.root)
+                if name.endswith('.snap')]
+        return sorted(fnmatch.filter(keys, pattern),
+                      key=lambda key: [int(part) if part.isdigit() else part
+                                       for part in re.split(r'(\d+)', key)])
+
+    def save(self, key, snapshot):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f'{self.path(key)}.{os.getpid()}.tmp'
+        torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, self.path(key))
+
+    def load(self, key):
+        assert os.path.isfile(self.path(key)), f'no snapshot "{key}"'
+        return torch.load(self.path(key), map_location='cpu', weights_only=True)
+
+    def save_batch(self, keys, state, cursors, events, **meta):
+        # state: (hidden [layers, batch, hidden_dim], event [1, batch]);
+        # cursors and events: one per row, events the piece so far
+        hidden, event = state
+        rng = {'torch_rng': torch.get_rng_state(),
+               'np_rng': get_np_state(np.random)}
+        for row, key in enumerate(keys):
+            self.save(key, dict(
+                rng, **meta,
+                hidden=hidden[:, row].detach().float().cpu().clone(),
+                event=int(event[0, row]),
+                cursor=int(cursors[row]),
+                events=torch.as_tensor(np.asarray(events[row], dtype=np.uint8))))
+
+    def load_batch(self, keys):
+        # -> state (hidden, event) with one row per key, the snapshots;
+        # the same key more than once forks it into several rows
+        snapshots = {key: self.load(key) for key in set(keys)}
+        rows = [snapshots[key] for key in keys]
+        hidden = torch.stack([snap['hidden'] for snap in rows], 1)
+        event = torch.tensor([[snap['event'] for snap in rows]])
+        return (hidden, event), rows
+
+
+def restore_rng(snapshot):
+    torch.set_rng_state(snapshot['torch_rng'])
+    set_np_state(np.random, snapshot['np_rng'])
+
+
+def quantize_model(model):
+    # int8 dynamic quantization of the GRU and the Linear layers, cpu only
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(model, {nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+
+def load_model(sess_path):
+    # Also takes the int8 sessions written by quantize.py and the
+    # inference files written by export.py. Files of plain tensors (export.py
+    # ones) load weights-only and memory mapped, the weights are paged in
+    # from the file instead of being unpickled and copied.
+    try:
+        state = torch.load(sess_path, map_location='cpu', mmap=True,
+                           weights_only=True)
+        mapped = True
+    except (pickle.UnpicklingError, RuntimeError):  # pickled objects, old format
+        state = torch.load(sess_path, map_location='cpu', weights_only=False)
+        mapped = False
+    model = Model_RNN(**state['model_config'])
+    if state.get('quantized'):
+        model = quantize_model(model.eval())
+        mapped = False
+    model.load_state_dict(state['model_state'], assign=mapped)
+    model = model.to(device)
+    model.eval()
+    return model
+
+
 def getopt():
     parser = optparse.OptionParser()
 
     parser.add_option('-c',
                       dest='control',
                       type='string',
-                      default=None)
+                      action='append',
+                      default=None,
+                      help='control file, directory or "histogram;density"; '
+                           'given more than once, the rows take them in turn')
+
+    parser.add_option('--control-cache',
+                      dest='control_cache',
+                      type='string',
+                      default='cache/controls/',
+                      help='where controls read from -c files are kept, '
+                           'by file hash ("" = off)')
 
     parser.add_option('-b',
                       dest='batch_size',
@@ -416,88 +1387,351 @@ def getopt():
 
     parser.add_option('-l',
                       dest='max_len',
-                      type='int',
-                      default=1100)
+                      type='string',
+                      default='1100',
+                      help='steps to generate, or comma separated steps '
+                           'of the rows in turn')
     
     parser.add_option('-f',
                       dest='font_path',
                       type='string',
                       default='')
 
-    return parser.parse_args()[0]
+    parser.add_option('--bf16',
+                      dest='bf16',
+                      action='store_true',
+                      default=False,
+                      help='generate with bfloat16 weights')
 
+    parser.add_option('--render-workers',
+                      dest='render_workers',
+                      type='int',
+                      default=None,
+                      help='fluidsynth processes rendering wav files at a time '
+                           '(default: cpu count)')
 
-opt = getopt()
+    parser.add_option('--primer',
+                      dest='primer',
+                      type='string',
+                      default=None,
+                      help='continue this midi/.data/.npy file, or the files '
+                           'of a directory one per row')
 
-#------------------------------------------------------------------------
+    parser.add_option('--primer-len',
+                      dest='primer_len',
+                      type='int',
+                      default=0,
+                      help='use only the last N events of the primer (0 = all)')
+
+    parser.add_option('--keep-primer',
+                      dest='keep_primer',
+                      action='store_true',
+                      default=False,
+                      help='write the primer (or the piece of --resume) '
+                           'before the continuation')
+
+    parser.add_option('--greedy',
+                      dest='greedy',
+                      type='string',
+                      default='1.0',
+                      help='share of steps that take the most likely event '
+                           'instead of sampling (default 1), or comma '
+                           'separated shares of the rows in turn')
 
-output_dir = opt.output_dir
-sess_path = opt.sess_path
-batch_size = opt.batch_size
-max_len = opt.max_len
-control = opt.control 
-font = opt.font_path
+    parser.add_option('--temperature',
+                      dest='temperature',
+                      type='string',
+                      default='1.0',
+                      help='sampling temperature, or comma separated '
+                           'temperatures of the rows in turn')
 
-assert os.path.isfile(sess_path), f'"{sess_path}" is not a file'
+    parser.add_option('--seconds',
+                      dest='seconds',
+                      type='string',
+                      default=None,
+                      help='seconds of music per row, or comma separated '
+                           'seconds of the rows in turn; a row stops when it '
+                           'has them, -l is then the most steps it may take')
 
-if control is not None:
-    if os.path.isfile(control):
-        _, compressed_controls = torch.load(control, map_location='cpu')
-        controls = ControlSeq.recover_compressed_array(compressed_controls)
-        controls = torch.tensor(controls, dtype=torch.float32)
-        controls = controls.unsqueeze(1).repeat(1, batch_size, 1).to(device)
-    else:
-        pitch_histogram, note_density = control.split(';')
-        pitch_histogram = list(filter(len, pitch_histogram.split(',')))
-        if len(pitch_histogram) == 0:
-            pitch_histogram = np.ones(12) / 12
-        else:
-            pitch_histogram = np.array(list(map(float, pitch_histogram)))
-            assert pitch_histogram.size == 12
-            assert np.all(pitch_histogram >= 0)
-            pitch_histogram = pitch_histogram / pitch_histogram.sum() \
-                              if pitch_histogram.sum() else np.ones(12) / 12
-        note_density = int(note_density)
-        assert note_density in range(len(ControlSeq.note_density_bins))
-        control = Control(pitch_histogram, note_density)
-        controls = torch.tensor(control.conv2array(), dtype=torch.float32)
-        controls = controls.repeat(1, batch_size, 1).to(device)
-        control = repr(control)
-
-else:
-    controls = None
-    control = 'NONE'
-
-#------------------------------------------------------------------------
-print('=' * 80)
-
-state = torch.load(sess_path, map_location='cpu')
-model = Model_RNN(**state['model_config']).to(device)
-model.load_state_dict(state['model_state'])
-model.eval()
-print('=' * 80)
-
-init = torch.randn(batch_size, model.init_dim).to(device)
-
-outputs = model.gen_samples(init, max_len, controls=controls)
-
-outputs = outputs.cpu().numpy().T # [batch, steps]
-
-os.makedirs(output_dir, exist_ok=True)
-files = []
-for i, output in enumerate(outputs):
-    if (i != 0) or (i != batch_size - 1):
-        name = f'{i}.mid'
-        path = os.path.join(output_dir, name)
-        files.append(name)
-        n_notes = event_indec2midi_file(output, path)
-
-
-if len(font):
-    from midi2audio import FluidSynth
-    for i, sample in enumerate(files):
-        if (i == 0) or (i == batch_size - 1):
-            continue
-        fs = FluidSynth(font)
-        fs.midi_to_audio(output_dir + sample, os.path.join(output_dir, f'{i}.wav'))
+    parser.add_option('--snapshot-dir',
+                      dest='snapshot_dir',
+                      type='string',
+                      default='snapshots/')
+
+    parser.add_option('--save-snapshot',
+                      dest='save_snapshot',
+                      type='string',
+                      default=None,
+                      help='NAME, save the state of every row as '
+                           'NAME-<row>-<step> when done')
+
+    parser.add_option('--snapshot-every',
+                      dest='snapshot_every',
+                      type='int',
+                      default=0,
+                      help='also save snapshots every N steps')
+
+    parser.add_option('--resume',
+                      dest='resume',
+                      type='string',
+                      default=None,
+                      help='comma separated snapshot keys or patterns '
+                           '(NAME-*), given to the rows in turn; one key '
+                           'forks into the whole batch')
+
+    parser.add_option('--stream',
+                      dest='stream',
+                      action='store_true',
+                      default=False,
+                      help='write notes to the midi files while generating')
+
+    parser.add_option('--chunk',
+                      dest='chunk_size',
+                      type='int',
+                      default=32)
 
+    parser.add_option('--log',
+                      dest='log_path',
+                      type='string',
+                      default=None,
+                      help='append phase timings and speed as a json line here')
+
+    parser.add_option('--profile',
+                      dest='trace_path',
+                      type='string',
+                      default=None,
+                      help='trace generation with torch.profiler into this '
+                           'chrome trace file')
+
+    return parser.parse_args()[0]
+
+
+if __name__ == '__main__':
+    startup = process_seconds()  # imports done
+    opt = getopt()
+
+    #------------------------------------------------------------------------
+
+    output_dir = opt.output_dir
+    sess_path = opt.sess_path
+    batch_size = opt.batch_size
+    lengths = row_values(opt.max_len, batch_size, int)  # one or one per row
+    max_len = int(np.max(lengths))
+    greedy = row_values(opt.greedy, batch_size)
+    temperature = row_values(opt.temperature, batch_size)
+    assert np.all(temperature > 0), 'temperature must be positive'
+    seconds = None
+    if opt.seconds is not None:
+        seconds = row_values(opt.seconds, batch_size)
+    control = opt.control 
+    font = opt.font_path
+
+    assert os.path.isfile(sess_path), f'"{sess_path}" is not a file'
+
+    store = Snapshot_Store(opt.snapshot_dir)
+    snapshots = None
+    if opt.resume is not None:
+        assert opt.primer is None, '--resume and --primer both set the start'
+        keys = [key for pattern in opt.resume.split(',')
+                for key in (store.keys(pattern) or [pattern])]
+        row_keys = [keys[row % len(keys)] for row in range(batch_size)]
+        resumed, snapshots = store.load_batch(row_keys)
+        print('Resume:', ', '.join(dict.fromkeys(row_keys)))
+        if control is None:
+            control = snapshots[0].get('control')
+    assert not ((opt.save_snapshot or opt.snapshot_every) and opt.stream), \
+        'snapshots are taken between steps of whole batches, not --stream'
+    assert not (opt.stream and opt.keep_primer), \
+        '--keep-primer needs whole rows, not --stream'
+    assert not (opt.stream and (np.ndim(lengths) or seconds is not None)), \
+        '--stream generates the same length for every row'
+    assert opt.stream or np.all(lengths > 0), \
+        '-l must be positive (-l 0 generates without end only with --stream)'
+    assert opt.snapshot_every >= 0, '--snapshot-every must not be negative'
+    control_spec = control  # kept in the snapshots
+
+    if control is not None:
+        controls, control = load_controls(control, batch_size,
+                                          opt.control_cache)
+        controls = controls.to(device)
+        print('Control:', ', '.join(dict.fromkeys(control)))
+    else:
+        controls = None
+        control = 'NONE'
+
+    #------------------------------------------------------------------------
+    print('=' * 80)
+
+    timer = Phase_Timer()
+    with timer.phase('load'):
+        model = load_model(sess_path)
+        if opt.bf16:
+            model = model.to(torch.bfloat16)
+    print('=' * 80)
+
+    init = torch.randn(batch_size, model.init_dim).to(device)
+
+    start = primers = prefix = None
+    cursor = 0  # steps of the piece generated before this run, per row
+    if snapshots is not None:
+        restore_rng(snapshots[0])
+        hidden, event = resumed
+        start = (hidden.to(model.event_embedding.weight.dtype).to(device),
+                 event.to(device))
+        cursor = np.array([snap['cursor'] for snap in snapshots])
+        prefix = [snap['events'].numpy() for snap in snapshots]
+    if opt.primer is not None:
+        primers, primer_controls, primer_paths = load_primers(
+            opt.primer, batch_size, opt.primer_len)
+        print('Primer:', ', '.join(dict.fromkeys(primer_paths)))
+        with timer.phase('prefill'):
+            start = model.prefill(init, primers, primer_controls.to(device))
+        prefill_seconds = timer.totals['prefill']
+        n_primer = sum(len(events) for events in primers)
+        print(f'Prefilled {n_primer} primer events in {prefill_seconds:.2f}s '
+              f'({n_primer / prefill_seconds:.0f} events/s)')
+        prefix = primers
+
+    os.makedirs(output_dir, exist_ok=True)
+    files = [f'{i}.mid' for i in range(batch_size)]
+    paths = [os.path.join(output_dir, name) for name in files]
+
+    renderer = Audio_Renderer(font, opt.render_workers) if font else None
+    first_file = None
+
+    def mark_first_file():
+        # counted from the start of the process; with --stream, the
+        # first notes written
+        global first_file
+        if first_file is None:
+            first_file = process_seconds()
+
+    def on_file(row, path):
+        mark_first_file()
+        if renderer is not None:
+            renderer.submit(path)
+
+    profiler = make_profiler(opt.trace_path) if opt.trace_path else None
+    if profiler is not None:
+        profiler.start()
+
+    if opt.stream:
+        n_events, music_seconds = 0, 0.
+
+        def timed_chunks(chunks):
+            # generation time of each chunk, the rest of the loop is writing
+            global n_events, music_seconds
+            while True:
+                with timer.phase('generate'):
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        return
+                    chunk = chunk.cpu().numpy()
+                n_events += chunk.size
+                music_seconds += event_indec2seconds(chunk.T).sum()
+                yield chunk
+
+        stream_start = time.perf_counter()
+        generate_before = timer.totals.get('generate', 0.)
+        if snapshots is not None:  # the controls go on from the snapshots
+            controls = control_window(controls, cursor, max_len or 1)
+        chunks = model.gen_stream(init, max_len or None, controls=controls,
+                                  greedy=greedy, temperature=temperature,
+                                  chunk_size=opt.chunk_size, start=start)
+        stream2midi_files(timed_chunks(chunks), paths,
+                          callback=lambda row, notes: mark_first_file())
+        timer.add('write', time.perf_counter() - stream_start
+                           - (timer.totals['generate'] - generate_before))
+        if renderer is not None:
+            for path in paths:
+                renderer.submit(path)
+    else:
+        if isinstance(model.gru, nn.GRU):
+            generate = Step_Engine(model, batch_size).gen_samples
+        else:  # int8 session
+            generate = model.gen_samples
+
+        # rows of their own length or --seconds leave the batch when done
+        stop = None
+        if np.ndim(lengths) or seconds is not None:
+            stop = Row_Stop(batch_size, lengths, seconds)
+
+        # in segments of --snapshot-every steps; a segment goes on from
+        # the state the last one stopped at, so the events are the same
+        segment = opt.snapshot_every or max_len
+        state, outputs = start, []
+        for begin in range(0, max_len, segment):
+            if stop is not None and not len(stop.active):
+                break
+            steps = min(segment, max_len - begin)
+            window = control_window(controls, cursor + begin, steps)
+            with timer.phase('generate'):
+                events, state = generate(
+                    init, steps, controls=window, greedy=greedy,
+                    temperature=temperature, start=state, return_state=True,
+                    stop=stop)
+                outputs.append(events.cpu().numpy())
+            if opt.save_snapshot:
+                with timer.phase('snapshot'):
+                    done = np.concatenate(outputs).T
+                    if stop is not None:
+                        done = [row[:n] for row, n in zip(done, stop.steps)]
+                    pieces = done if prefix is None else \
+                        [np.concatenate([events, row])
+                         for events, row in zip(prefix, done)]
+                    at = cursor + (begin + steps if stop is None else stop.steps)
+                    at = at if np.ndim(at) else [at] * batch_size
+                    keys = [f'{opt.save_snapshot}-{row}-{at[row]}'
+                            for row in range(batch_size)]
+                    store.save_batch(keys, state, at, pieces,
+                                     sess_path=sess_path, control=control_spec)
+        outputs = np.concatenate(outputs).T # [batch, steps]
+        if stop is not None:  # rows of their own length
+            outputs = [row[:n] for row, n in zip(outputs, stop.steps)]
+            print(f'Rows stopped early: {stop.steps.sum()} of '
+                  f'{batch_size * max_len} row steps, '
+                  f'{stop.steps.max()} of {max_len} batch steps')
+        n_events = sum(len(row) for row in outputs)
+        music_seconds = sum(event_indec2seconds(row).sum()  # generated only
+                            for row in outputs)
+
+        if opt.keep_primer and prefix is not None:
+            outputs = [np.concatenate([events, row])
+                       for events, row in zip(prefix, outputs)]
+        n_notes = event_indec2midi_files(outputs, paths, callback=on_file,
+                                         timer=timer)
+
+    if profiler is not None:
+        profiler.stop()
+        print('Trace saved to', opt.trace_path)
+
+    if renderer is not None:
+        with timer.phase('render'):  # what is left after the last file
+            renderer.close()
+
+    report = timer.report()
+    generate_seconds = report['phases']['generate']['seconds']
+    record = {
+        'sess_path': sess_path,
+        'batch_size': batch_size,
+        'events': int(n_events),
+        'wall': report['wall'],
+        'phases': {name: phase['seconds']
+                   for name, phase in report['phases'].items()},
+        'events_per_sec': n_events / generate_seconds,
+        'music_seconds': float(music_seconds),
+        'real_time_factor': music_seconds / generate_seconds,
+        'peak_rss_mb': peak_rss_bytes() / 2**20,
+        'startup': startup,
+        'first_file': first_file,
+    }
+    if first_file is not None:
+        print(f'first file after {first_file:.2f}s ({startup:.2f}s start up)')
+    print(f'{n_events} events, {record["events_per_sec"]:.0f} events/s, '
+          f'{music_seconds:.1f}s of music, real time x'
+          f'{record["real_time_factor"]:.1f}, '
+          f'peak RSS {record["peak_rss_mb"]:.0f}MB')
+    print(phase_summary(report))
+    metrics_log = Metrics_Log(opt.log_path)
+    metrics_log.write(record)
+    metrics_log.close()
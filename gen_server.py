@@ -0,0 +1,417 @@
+import torch
+import torch.nn.functional as F
+
+import numpy as np
+
+import os
+import json
+import time
+import asyncio
+import optparse
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+from gen_fin import load_control, parse_control, load_model, event_indec2smf, \
+    device, MIDI_EXTS
+
+MAX_BODY = 2**16  # bytes of a request body
+
+
+class Gen_Request:
+    # One piece asked for over the socket. The seed fixes everything that
+    # is random for it (init and the per-step draws), so the result does not
+    # depend on which other requests share its batch.
+
+    def __init__(self, length, init_dim, controls=None, seed=None, greedy=1.0,
+                 temperature=1.0):
+        assert length > 0, 'length must be positive'
+        assert temperature > 0, 'temperature must be positive'
+        self.length = length
+        self.controls = controls  # [steps, control_dim] or None
+        self.seed = seed if seed is not None else int(np.random.randint(2**31))
+        self.greedy = greedy
+        self.temperature = temperature
+        self.future = None
+        self.queued_at = time.time()
+
+        gen = torch.Generator().manual_seed(self.seed)
+        self.init = torch.randn(1, init_dim, generator=gen)
+        self.draws = torch.rand(length, 2, generator=gen)  # greedy, sample
+        self.events = np.zeros(length, np.int64)
+        self.step = 0
+
+    def control(self, step):
+        return self.controls[min(step, self.controls.shape[0] - 1)]
+
+
+class Batch_Server:
+    # Keeps the model loaded and steps all running requests through the GRU
+    # together. New requests join the running batch between steps, finished
+    # ones leave it; when idle, the first request waits up to wait_time for
+    # company before stepping starts.
+
+    def __init__(self, sess_path, max_batch=64, wait_time=0.05):
+        self.sess_path = sess_path
+        self.max_batch = max_batch
+        self.wait_time = wait_time
+        self.executor = ThreadPoolExecutor(1)
+        self.queue = asyncio.Queue()
+        self.rows = []
+        self.event = None
+        self.hidden = None
+        self.metrics = {
+            'requests': 0, 'finished': 0, 'failed': 0, 'steps': 0,
+            'row_steps': 0, 'max_batch_size': 0, 'reloads': 0,
+            'batch_sizes': collections.Counter(),
+        }
+        self._load()
+
+    def _sess_stamp(self):
+        stat = os.stat(self.sess_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        self.stamp = self._sess_stamp()
+        self.model = load_model(self.sess_path)
+        self.loaded_at = time.time()
+        print('Loaded', self.sess_path)
+
+    def _reload(self):
+        try:
+            self._load()
+            self.metrics['reloads'] += 1
+        except Exception as e:  # keep serving the old model
+            print('Reload failed:', repr(e))
+
+    def _sess_changed(self):
+        try:
+            return self._sess_stamp() != self.stamp
+        except OSError:  # being replaced right now
+            return False
+
+    def submit(self, request):
+        request.future = asyncio.get_running_loop().create_future()
+        self.metrics['requests'] += 1
+        self.queue.put_nowait(request)
+        return request.future
+
+    def _admit(self, requests):
+        # initialise2hidden views [batch, layers * hidden] as
+        # [layers, batch, hidden], which mixes rows of a batch, so every
+        # request gets its hidden state on its own
+        model = self.model
+        with torch.no_grad():
+            hidden = torch.cat([model.initialise2hidden(r.init.to(device))
+                                for r in requests], 1)
+        event = model.simple_event(len(requests))
+        if self.rows:
+            self.hidden = torch.cat([self.hidden, hidden], 1)
+            self.event = torch.cat([self.event, event], 1)
+        else:
+            self.hidden, self.event = hidden, event
+        self.rows.extend(requests)
+
+    def _step(self):
+        # one GRU step for every running row -> the rows that finished
+        model, rows = self.model, self.rows
+        batch_size = len(rows)
+
+        control = torch.zeros(1, batch_size, model.control_dim)
+        default = torch.ones(1, batch_size, 1)
+        for i, row in enumerate(rows):
+            if row.controls is not None:
+                control[0, i] = row.control(row.step)
+                default[0, i] = 0
+
+        draws = torch.stack([row.draws[row.step] for row in rows]).to(device)
+        greedy = torch.tensor([row.greedy for row in rows], device=device)
+        temperature = torch.tensor([row.temperature for row in rows],
+                                   device=device)
+
+        with torch.no_grad():
+            output, self.hidden = model.forw(self.event, control.to(device),
+                                             self.hidden, default.to(device))
+            output = output[0]
+            # inverse-cdf sampling with each row's own uniform draw
+            probs = F.softmax(output / temperature[:, None], -1)
+            cdf = probs.cumsum(-1)
+            sampled = torch.searchsorted(cdf, draws[:, 1:].contiguous())
+            sampled = sampled[:, 0].clamp(max=output.shape[-1] - 1)
+            event = torch.where(draws[:, 0] < greedy, output.argmax(-1), sampled)
+
+        events = event.cpu().numpy()
+        keep, done = [], []
+        for i, row in enumerate(rows):
+            row.events[row.step] = events[i]
+            row.step += 1
+            (done if row.step == row.length else keep).append(i)
+
+        self.event = event.unsqueeze(0)
+        if done:
+            keep_index = torch.tensor(keep, dtype=torch.long, device=device)
+            self.event = self.event[:, keep_index]
+            self.hidden = self.hidden[:, keep_index]
+            self.rows = [rows[i] for i in keep]
+
+        self.metrics['steps'] += 1
+        self.metrics['row_steps'] += batch_size
+        self.metrics['batch_sizes'][batch_size] += 1
+        self.metrics['max_batch_size'] = max(self.metrics['max_batch_size'],
+                                             batch_size)
+        return [(rows[i], event_indec2smf(rows[i].events)) for i in done]
+
+    def _finish(self, finished):
+        for row, midi in finished:
+            self.metrics['finished'] += 1
+            if not row.future.done():
+                row.future.set_result(midi)
+
+    async def _collect(self):
+        # first request of an idle server, then whoever comes in wait_time
+        requests = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_time
+        while len(requests) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return requests
+
+    def _drain(self, limit):
+        requests = []
+        while len(requests) < limit and not self.queue.empty():
+            requests.append(self.queue.get_nowait())
+        return requests
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        reload_pending = False
+        while True:
+            if not self.rows:
+                requests = await self._collect()
+                if reload_pending or self._sess_changed():
+                    await loop.run_in_executor(self.executor, self._reload)
+                    reload_pending = False
+            elif not reload_pending:
+                # rows already running keep the model they started with
+                reload_pending = self._sess_changed()
+                requests = [] if reload_pending else \
+                           self._drain(self.max_batch - len(self.rows))
+            else:
+                requests = []
+
+            try:
+                if requests:
+                    await loop.run_in_executor(self.executor, self._admit,
+                                               requests)
+                finished = await loop.run_in_executor(self.executor, self._step)
+            except Exception as e:
+                for row in self.rows + requests:
+                    self.metrics['failed'] += 1
+                    if not row.future.done():
+                        row.future.set_exception(e)
+                self.rows = []
+                continue
+            self._finish(finished)
+
+    def report(self):
+        metrics = dict(self.metrics)
+        steps = metrics['steps']
+        metrics['batch_sizes'] = dict(sorted(metrics['batch_sizes'].items()))
+        metrics['mean_batch_size'] = metrics['row_steps'] / steps if steps else 0
+        metrics['queue_depth'] = self.queue.qsize()
+        metrics['running'] = len(self.rows)
+        metrics['sess_path'] = self.sess_path
+        metrics['loaded_at'] = self.loaded_at
+        return metrics
+
+
+def resolve_control(control, controls_dir=None):
+    # The "control" of a request -> [steps, control_dim] float tensor.
+    # Only an inline 'histogram;density', or the name of a midi/.data file
+    # under controls_dir; nothing else on disk is opened for a client.
+    if not isinstance(control, str):
+        raise TypeError('control must be a string')
+    if ';' in control and os.sep not in control:
+        return parse_control(control)[0]
+    if not controls_dir:
+        raise ValueError('control must be "histogram;density" '
+                         '(the server has no controls directory)')
+    root = os.path.realpath(controls_dir)
+    path = os.path.realpath(os.path.join(root, control))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path) \
+       or not path.lower().endswith(MIDI_EXTS + ('.data',)):
+        raise ValueError(f'no control file "{control}"')
+    return path
+
+
+def parse_request(body, max_len, init_dim, control_cache=None,
+                  controls_dir=None):
+    # json body -> Gen_Request; length is clamped to max_len. Reads and
+    # hashes control files, so it runs off the event loop.
+    params = json.loads(body or b'{}')
+    if not isinstance(params, dict):
+        raise TypeError('the body must be a json object')
+    controls = params.get('control')
+    if controls is not None:
+        controls = resolve_control(controls, controls_dir)
+        if isinstance(controls, str):  # a file under controls_dir
+            controls, _ = load_control(controls, control_cache)
+    length = min(int(params.get('length', max_len)), max_len)
+    seed = params.get('seed')
+    return Gen_Request(length, init_dim, controls,
+                       None if seed is None else int(seed),
+                       float(params.get('greedy', 1.0)),
+                       float(params.get('temperature', 1.0)))
+
+
+async def write_response(writer, status, body, content_type, headers=()):
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+              500: 'Internal Server Error'}[status]
+    head = [f'HTTP/1.1 {status} {reason}',
+            f'Content-Type: {content_type}',
+            f'Content-Length: {len(body)}',
+            'Connection: close']
+    head.extend(f'{k}: {v}' for k, v in headers)
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+    await writer.drain()
+    writer.close()
+
+
+def make_handler(server, max_len, control_cache=None, controls_dir=None):
+    # POST /generate with a json body -> audio/midi, GET /metrics -> json
+    async def handle(reader, writer):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if not 0 <= length <= MAX_BODY:
+                await write_response(writer, 400, b'body too large\n',
+                                     'text/plain')
+                return
+            body = await reader.readexactly(length)
+        except (ValueError, UnicodeDecodeError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+
+        if len(request_line) < 2:
+            writer.close()
+            return
+        method, path = request_line[:2]
+
+        if method == 'GET' and path == '/metrics':
+            body = json.dumps(server.report()).encode()
+            await write_response(writer, 200, body, 'application/json')
+            return
+        if method != 'POST' or path != '/generate':
+            await write_response(writer, 404, b'not found\n', 'text/plain')
+            return
+
+        try:
+            request = await asyncio.get_running_loop().run_in_executor(
+                None, parse_request, body, max_len, server.model.init_dim,
+                control_cache, controls_dir)
+        except (ValueError, TypeError, AssertionError, LookupError) as e:
+            await write_response(writer, 400, f'{e!r}\n'.encode(), 'text/plain')
+            return
+        except Exception as e:
+            await write_response(writer, 500, f'{e!r}\n'.encode(), 'text/plain')
+            return
+        try:
+            midi = await server.submit(request)
+        except Exception as e:
+            await write_response(writer, 500, f'{e!r}\n'.encode(), 'text/plain')
+            return
+        await write_response(writer, 200, midi, 'audio/midi',
+                             [('X-Seed', request.seed)])
+    return handle
+
+
+def getopt():
+    parser = optparse.OptionParser()
+
+    parser.add_option('-s',
+                      dest='sess_path',
+                      type='string',
+                      default='save/train.sess')
+
+    parser.add_option('-l',
+                      dest='max_len',
+                      type='int',
+                      default=1100,
+                      help='length of a piece when the request has none, '
+                           'and the longest one served')
+
+    parser.add_option('-b',
+                      dest='max_batch',
+                      type='int',
+                      default=64)
+
+    parser.add_option('--wait',
+                      dest='wait_time',
+                      type='float',
+                      default=0.05,
+                      help='seconds an idle server waits to fill a batch')
+
+    parser.add_option('--controls-dir',
+                      dest='controls_dir',
+                      type='string',
+                      default=None,
+                      help='midi/.data files requests may name as control; '
+                           'without it only "histogram;density" is taken')
+
+    parser.add_option('--control-cache',
+                      dest='control_cache',
+                      type='string',
+                      default='cache/controls/',
+                      help='where controls read from control files are kept, '
+                           'by file hash ("" = off)')
+
+    parser.add_option('--host',
+                      dest='host',
+                      type='string',
+                      default='127.0.0.1')
+
+    parser.add_option('--port',
+                      dest='port',
+                      type='int',
+                      default=8000)
+
+    parser.add_option('--unix',
+                      dest='unix_path',
+                      type='string',
+                      default=None,
+                      help='listen on this unix socket instead of tcp')
+
+    return parser.parse_args()[0]
+
+
+async def main(opt):
+    server = Batch_Server(opt.sess_path, opt.max_batch, opt.wait_time)
+    handler = make_handler(server, opt.max_len, opt.control_cache,
+                           opt.controls_dir)
+    if opt.unix_path:
+        listener = await asyncio.start_unix_server(handler, opt.unix_path)
+        print('Listening on', opt.unix_path)
+    else:
+        listener = await asyncio.start_server(handler, opt.host, opt.port)
+        print(f'Listening on {opt.host}:{opt.port}')
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), server.run())
+
+
+if __name__ == '__main__':
+    opt = getopt()
+    assert os.path.isfile(opt.sess_path), f'"{opt.sess_path}" is not a file'
+    asyncio.run(main(opt))
@@ -0,0 +1,143 @@
+import torch
+
+import os
+import hashlib
+import optparse
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from progress.bar import Bar
+
+from train_f import Note_Seqce, Event_Seqce, ControlSeq, Work_w_Dataset
+from train_f import search_files
+
+
+def preprocess_midi(path):
+    note_seq = Note_Seqce.midi2noteseq_file(path)
+    if not note_seq.notes:
+        return None
+    note_seq.adjust_time(-note_seq.notes[0].start)
+    event_seq = Event_Seqce.take_from_note_seq(note_seq)
+    return event_seq.conv2array(), \
+           ControlSeq.take_compressed_from_event_seq(event_seq)
+
+
+def content_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+SKIPPED_FILE = 'skipped.txt'
+
+
+def processed_hashes(save_dir):
+    # saved files are named '<midi name>-<content hash>.data'; the hashes
+    # of files that failed or had no notes are in skipped.txt
+    hashes = set()
+    for path in search_files(save_dir, ['.data']):
+        name = os.path.basename(path)[:-len('.data')]
+        hashes.add(name.rsplit('-', 1)[-1])
+    return hashes | set(skipped_hashes(save_dir))
+
+
+def skipped_hashes(save_dir):
+    # -> {hash: 'path<tab>reason'} of skipped.txt
+    path = os.path.join(save_dir, SKIPPED_FILE)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return dict(line.rstrip('\n').split('\t', 1) for line in f if '\t' in line)
+
+
+def record_skipped(save_dir, skipped):
+    # appends (hash, path, reason) lines to skipped.txt; delete a line, or
+    # the file, to try those files again
+    with open(os.path.join(save_dir, SKIPPED_FILE), 'a') as f:
+        for code, path, reason in skipped:
+            f.write(f'{code}\t{path}\t{reason}\n')
+
+
+def save_data(data, save_path):
+    # write next to the target and rename, so an interrupted run never
+    # leaves a half-written file that looks processed
+    tmp_path = save_path + '.tmp'
+    torch.save(data, tmp_path)
+    os.replace(tmp_path, save_path)
+
+
+def preprocess_midi_files_under(midi_root, save_dir, num_workers):
+    midi_paths = list(search_files(midi_root, ['.mid', '.midi']))
+    os.makedirs(save_dir, exist_ok=True)
+    out_fmt = '{}-{}.data'
+
+    done = processed_hashes(save_dir)
+    skipped = skipped_hashes(save_dir)
+    todo, n_skipped = {}, 0
+    for path in midi_paths:
+        code = content_hash(path)
+        n_skipped += code in skipped
+        if code not in done and code not in todo:
+            todo[code] = path
+    print(f'{len(midi_paths)} files, {len(todo)} new or changed, '
+          f'{n_skipped} skipped before (see {SKIPPED_FILE})')
+    if not todo:
+        return 0
+
+    failed = []
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = {executor.submit(preprocess_midi, path): (code, path)
+                   for code, path in todo.items()}
+        bar = Bar('Processing', max=len(futures))
+        for future in bar.iter(as_completed(futures)):
+            code, path = futures[future]
+            try:
+                data = future.result()
+            except Exception as e:
+                failed.append((code, path, ' '.join(repr(e).split())))
+                continue
+            if data is None:
+                failed.append((code, path, 'no notes'))
+                continue
+            name = os.path.basename(path)
+            save_data(data, os.path.join(save_dir, out_fmt.format(name, code)))
+
+    record_skipped(save_dir, failed)
+    for _, path, e in failed:
+        print('Skipped', path, e)
+    return len(todo) - len(failed)
+
+
+def getopt():
+    parser = optparse.OptionParser()
+
+    parser.add_option('-m',
+                      dest='midi_root',
+                      type='string',
+                      default='dataset/midi/')
+
+    parser.add_option('-d',
+                      dest='save_dir',
+                      type='string',
+                      default='dataset/processed/')
+
+    parser.add_option('-w',
+                      dest='num_workers',
+                      type='int',
+                      default=os.cpu_count())
+
+    parser.add_option('-p',
+                      dest='pack',
+                      action='store_true',
+                      default=False,
+                      help='also write the packed, memory-mapped dataset')
+
+    return parser.parse_args()[0]
+
+
+if __name__ == '__main__':
+    opt = getopt()
+    n_new = preprocess_midi_files_under(opt.midi_root, opt.save_dir,
+                                        opt.num_workers)
+    if opt.pack and (n_new or not Work_w_Dataset.is_packed(opt.save_dir)
+                     or Work_w_Dataset.pack_is_stale(opt.save_dir)):
+        n_samples = Work_w_Dataset.pack(opt.save_dir)
+        print(f'Packed {n_samples} samples into', opt.save_dir)
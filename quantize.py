@@ -0,0 +1,195 @@
+import torch
+import torch.nn.functional as F
+
+import numpy as np
+
+import io
+import os
+import sys
+import time
+import subprocess
+import optparse
+
+from gen_fin import ControlSeq, Step_Engine, load_model, quantize_model, \
+    device
+
+
+def quantize_sess(sess_path, save_path):
+    state = torch.load(sess_path, map_location='cpu')
+    model = quantize_model(load_model(sess_path))
+    torch.save({'model_config': state['model_config'],
+                'model_state': model.state_dict(),
+                'quantized': 'qint8'}, save_path)
+    return model
+
+
+def model_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def used_rss(sess_path):
+    # -> RSS after the imports, RSS after loading sess_path and generating
+    # a few steps (memory mapped weights are only paged in when used)
+    before = rss_bytes()
+    model = load_model(sess_path)
+    init = torch.randn(1, model.init_dim).to(device)
+    with torch.no_grad():
+        if isinstance(model.gru, torch.nn.GRU):
+            Step_Engine(model, 1).gen_samples(init, 10)
+        else:  # int8 session
+            model.gen_samples(init, 10)
+    return before, rss_bytes()
+
+
+def load_rss(sess_path):
+    # RSS used_rss adds in a fresh process, one per file, so one model and
+    # what the allocator kept of it do not count for the other
+    code = 'import sys, quantize; print(*quantize.used_rss(sys.argv[1]))'
+    out = subprocess.run([sys.executable, '-c', code, sess_path], check=True,
+                         capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    before, after = map(int, out.stdout.split()[-2:])
+    return after - before
+
+
+def events_per_sec(model, batch_size, steps, seed=0):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    init = torch.randn(batch_size, model.init_dim).to(device)
+    with torch.no_grad():
+        model.gen_samples(init, 10)  # warm up
+        start = time.time()
+        model.gen_samples(init, steps)
+    return batch_size * steps / (time.time() - start)
+
+
+def load_control_files(control_dir, steps):
+    # -> events [steps, batch], controls [steps, batch, control_dim], names
+    names, events, controls = [], [], []
+    for name in sorted(os.listdir(control_dir)):
+        if not name.endswith('.data'):
+            continue
+        event_seq, compressed = torch.load(os.path.join(control_dir, name),
+                                           map_location='cpu',
+                                           weights_only=False)
+        if len(event_seq) < steps:
+            continue
+        names.append(name)
+        events.append(np.asarray(event_seq[:steps]))
+        controls.append(ControlSeq.recover_compressed_array(compressed[:steps]))
+    events = torch.tensor(np.stack(events, 1), dtype=torch.long)
+    controls = torch.tensor(np.stack(controls, 1), dtype=torch.float32)
+    return events, controls, names
+
+
+def next_event_divergence(models, events, controls, seed=0):
+    # Feed the same recorded events and controls to both models and compare
+    # the distributions they give for the next event at every step.
+    # -> KL(models[0] || models[1]) and argmax agreement, each [steps, batch]
+    batch_size = events.shape[1]
+    torch.manual_seed(seed)
+    init = torch.randn(batch_size, models[0].init_dim).to(device)
+    events, controls = events.to(device), controls.to(device)
+    hiddens = [model.initialise2hidden(init) for model in models]
+    event = models[0].simple_event(batch_size)
+    kl, agree = [], []
+    with torch.no_grad():
+        for step in range(events.shape[0]):
+            log_probs = []
+            for i, model in enumerate(models):
+                output, hiddens[i] = model.forw(event, controls[step:step+1],
+                                                hiddens[i])
+                log_probs.append(F.log_softmax(output[0].float(), -1))
+            p, q = log_probs
+            kl.append((p.exp() * (p - q)).sum(-1))
+            agree.append(p.argmax(-1) == q.argmax(-1))
+            event = events[step:step+1]
+    return torch.stack(kl).cpu().numpy(), torch.stack(agree).cpu().numpy()
+
+
+def compare(sess_path, quantized_path, control_dir, steps, batch_sizes):
+    model = load_model(sess_path)
+    qmodel = load_model(quantized_path)
+    models = {'fp32': model, 'int8': qmodel}
+    fp32_rss = load_rss(sess_path)
+    int8_rss = load_rss(quantized_path)
+
+    print('=' * 80)
+    print(f'{"":6}{"weights MB":>12}{"load RSS MB":>14}', end='')
+    print(''.join(f'{f"ev/s b={b}":>12}' for b in batch_sizes))
+    for name, rss in [('fp32', fp32_rss), ('int8', int8_rss)]:
+        speeds = [events_per_sec(models[name], b, steps) for b in batch_sizes]
+        print(f'{name:6}{model_bytes(models[name]) / 2**20:12.1f}'
+              f'{rss / 2**20:14.1f}', end='')
+        print(''.join(f'{speed:12.0f}' for speed in speeds))
+
+    events, controls, names = load_control_files(control_dir, steps)
+    kl, agree = next_event_divergence([model, qmodel], events, controls)
+    print('=' * 80)
+    print(f'next event, fp32 vs int8, {steps} steps of each control file')
+    print(f'{"file":20}{"mean KL":>10}{"max KL":>10}{"argmax agree":>14}')
+    for i, name in enumerate(names):
+        print(f'{name:20}{kl[:, i].mean():10.5f}{kl[:, i].max():10.5f}'
+              f'{agree[:, i].mean():14.3f}')
+    print(f'{"all":20}{kl.mean():10.5f}{kl.max():10.5f}{agree.mean():14.3f}')
+
+
+def getopt():
+    parser = optparse.OptionParser()
+
+    parser.add_option('-s',
+                      dest='sess_path',
+                      type='string',
+                      default='save/train.sess')
+
+    parser.add_option('-o',
+                      dest='output_path',
+                      type='string',
+                      default=None,
+                      help='where to save the int8 session '
+                           '(default: next to -s with .int8.sess)')
+
+    parser.add_option('--compare',
+                      dest='compare',
+                      action='store_true',
+                      default=False,
+                      help='compare the int8 session with the fp32 one')
+
+    parser.add_option('-c',
+                      dest='control_dir',
+                      type='string',
+                      default='test_train/')
+
+    parser.add_option('-l',
+                      dest='steps',
+                      type='int',
+                      default=500)
+
+    parser.add_option('-b',
+                      dest='batch_sizes',
+                      type='string',
+                      default='1,8,64')
+
+    return parser.parse_args()[0]
+
+
+if __name__ == '__main__':
+    opt = getopt()
+    assert os.path.isfile(opt.sess_path), f'"{opt.sess_path}" is not a file'
+    output_path = opt.output_path or \
+                  os.path.splitext(opt.sess_path)[0] + '.int8.sess'
+
+    quantize_sess(opt.sess_path, output_path)
+    print('Saved', output_path)
+
+    if opt.compare:
+        batch_sizes = [int(b) for b in opt.batch_sizes.split(',')]
+        compare(opt.sess_path, output_path, opt.control_dir, opt.steps,
+                batch_sizes)
@@ -0,0 +1,127 @@
+import torch
+
+import os
+import json
+import time
+import resource
+import contextlib
+import collections
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def process_seconds():
+    # seconds since this process started, interpreter start up and imports
+    # included; None without /proc
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+class Phase_Timer:
+    # Wall-clock seconds per named phase, summed until report(). Phases also
+    # show up by name in a torch.profiler trace. sync, if given, runs at
+    # both ends of a phase so queued device work counts where it was queued.
+
+    def __init__(self, sync=None):
+        self.sync = sync
+        self.reset()
+
+    def reset(self):
+        self.totals = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.sync is not None:
+            self.sync()
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            if self.sync is not None:
+                self.sync()
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.) + seconds
+        self.counts[name] += 1
+
+    def report(self, reset=True):
+        # -> {'wall': seconds since the last reset,
+        #     'phases': {name: {'seconds', 'count', 'share'}}}
+        wall = time.perf_counter() - self.started
+        phases = collections.OrderedDict()
+        for name, seconds in self.totals.items():
+            phases[name] = {'seconds': seconds, 'count': self.counts[name],
+                            'share': seconds / wall if wall else 0.}
+        if reset:
+            self.reset()
+        return {'wall': wall, 'phases': phases}
+
+
+class Metrics_Log:
+    # One json object per line, appended and flushed as it comes;
+    # without a path the records are dropped
+
+    def __init__(self, path=None):
+        self.file = open(path, 'a') if path else None
+
+    def write(self, record):
+        if self.file is None:
+            return
+        record = dict(record, time=time.time())
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def parse_range(text):
+    # 'A:B' -> (A, B), first and one past the last iteration
+    start, _, stop = text.partition(':')
+    start, stop = int(start), int(stop)
+    assert 0 <= start < stop, f'bad range "{text}"'
+    return start, stop
+
+
+def make_profiler(trace_path, skip=0, active=None):
+    # torch.profiler that writes a chrome trace to trace_path. With active
+    # it ignores the first skip steps and records the next active ones, the
+    # caller calls .step() after each step; without it, it records from
+    # start() to stop(). One of the skipped steps is a warmup step when
+    # there is one, the profiler warns otherwise.
+    schedule = None
+    if active is not None:
+        warmup = min(skip, 1)
+        schedule = torch.profiler.schedule(wait=skip - warmup, warmup=warmup,
+                                           active=active, repeat=1)
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=schedule,
+        on_trace_ready=lambda prof: prof.export_chrome_trace(trace_path),
+        record_shapes=True,
+        profile_memory=True)
+
+
+def phase_summary(report, per=1):
+    # 'fetch 1.2ms 3% | forward ...', milliseconds divided by per
+    return ' | '.join(f'{name} {phase["seconds"] / per * 1e3:.1f}ms '
+                      f'{phase["share"]:.0%}'
+                      for name, phase in report['phases'].items())
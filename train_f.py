@@ -10,9 +10,13 @@ import sys
 import time
 import optparse
 
-import copy, itertools, collections
+import copy, itertools, collections, struct
+import queue, threading, shutil, zlib
 from pretty_midi import PrettyMIDI, Note, Instrument
 
+from timing import Phase_Timer, Metrics_Log, make_profiler, parse_range, \
+                   phase_summary, peak_rss_bytes
+
 STATE_RESOLUTION = 220
 STATE_TEMP = 120
 STATE_VELOCITY = 52
@@ -29,6 +33,8 @@ MIN_NOTE_LENGTH = BEAT_LENGTH / 2
 STATE_WINDOW_SIZE = BEAT_LENGTH * 4
 STATE_NOTE_DENSITY_BINS = np.arange(12) * 3 + 1
 
+DEFAULT_LOADING_PROGRAMS = range(128)
+
 
 class Note_Seqce:
     def __init__(self, notes=[]):
@@ -48,16 +54,17 @@ class Note_Seqce:
         midi.instruments.append(inst)
         return midi
     
+    @staticmethod
     def midi2noteseq(midi, programs=DEFAULT_LOADING_PROGRAMS):
         notes = itertools.chain(*[
             inst.notes for inst in midi.instruments
             if inst.program in programs and not inst.is_drum])
-        return NoteSeq(list(notes))
+        return Note_Seqce(list(notes))
 
     @staticmethod
     def midi2noteseq_file(path, *kargs, **kwargs):
         midi = PrettyMIDI(path)
-        return NoteSeq.midi2noteseq(midi, *kargs, **kwargs)
+        return Note_Seqce.midi2noteseq(midi, *kargs, **kwargs)
 
 
     def convert2midi_file(self, path, *kargs, **kwargs):
@@ -68,6 +75,11 @@ class Note_Seqce:
         self.notes += notes
         self.notes.sort(key=lambda note: note.start)
 
+    def adjust_time(self, offset):
+        for note in self.notes:
+            note.start += offset
+            note.end += offset
+
 
 
 class Event:
@@ -92,16 +104,63 @@ class Event_Seqce:
     
     @staticmethod
     def take_from_array(event_indeces):
-        time = 0
+        return Event_Seqce.take_from_batch(np.asarray(event_indeces)[None])[0]
+
+    @staticmethod
+    def take_from_batch(event_indeces):
+        # [batch, steps] -> list of Event_Seqce, decoded in one pass
+        event_indeces = np.asarray(event_indeces)
+        types, values, times = Event_Seqce.decode_array(event_indeces)
+        event_seqs = []
+        for i in range(event_indeces.shape[0]):
+            event_seq = Event_Seqce()
+            event_seq._events = None
+            event_seq._indeces = event_indeces[i]
+            event_seq._decoded = (types[i], values[i], times[i])
+            event_seqs.append(event_seq)
+        return event_seqs
+
+    @staticmethod
+    def decode_array(event_indeces):
+        # [..., steps] -> types, values, times with the same shape
+        event_indeces = np.asarray(event_indeces, dtype=np.int64)
+        types = EVENT_TYPE_TABLE[event_indeces]
+        values = EVENT_VALUE_TABLE[event_indeces]
+        shifts = EVENT_SHIFT_TABLE[event_indeces]
+        times = np.zeros(shifts.shape)
+        np.cumsum(shifts[..., :-1], axis=-1, out=times[..., 1:]) # time before the event
+        return types, values, times
+
+    @staticmethod
+    def take_from_note_seq(note_seq):
+        note_events = []
+        velocity_bins = Event_Seqce.getting_veloc_basket()
+        for note in note_seq.notes:
+            if note.pitch in Event_Seqce.pitch_range:
+                velocity = note.velocity
+                velocity = max(velocity, Event_Seqce.velocity_range.start)
+                velocity = min(velocity, Event_Seqce.velocity_range.stop - 1)
+                velocity_index = np.searchsorted(velocity_bins, velocity)
+                pitch_index = note.pitch - Event_Seqce.pitch_range.start
+                note_events.append(Event('velocity', note.start, velocity_index))
+                note_events.append(Event('note_on', note.start, pitch_index))
+                note_events.append(Event('note_off', note.end, pitch_index))
+
+        note_events.sort(key=lambda event: event.time) # stable
+
         events = []
-        for event_index in event_indeces:
-            for event_type, feat_range in Event_Seqce.featur_ranges().items():
-                if feat_range.start <= event_index < feat_range.stop:
-                    event_value = event_index - feat_range.start
-                    events.append(Event(event_type, time, event_value))
-                    if event_type == 'time_shift':
-                        time += Event_Seqce.time_shift_bins[event_value]
-                    break
+        for i, event in enumerate(note_events):
+            events.append(event)
+            if i == len(note_events) - 1:
+                break
+
+            interval = note_events[i + 1].time - event.time
+            shift = 0
+            while interval - shift >= Event_Seqce.time_shift_bins[0]:
+                index = np.searchsorted(Event_Seqce.time_shift_bins,
+                                        interval - shift, side='right') - 1
+                events.append(Event('time_shift', event.time + shift, index))
+                shift += Event_Seqce.time_shift_bins[index]
 
         return Event_Seqce(events)
 
@@ -136,15 +195,31 @@ class Event_Seqce:
                 n / (Event_Seqce.velocity_steps - 1))
 
     def __init__(self, events=[]):
-        self.events = copy.deepcopy(events)
+        self._events = copy.deepcopy(events)
+        self._indeces = None
+        self._decoded = None
         time = 0
-        for event in self.events:
+        for event in self._events:
             event.time = time
             if event.type == 'time_shift':
                 time += Event_Seqce.time_shift_bins[event.value]
+
+    @property
+    def events(self):
+        if self._events is None:
+            types, values, times = self._decoded
+            self._events = [Event(EVENT_TYPES[t], time, value)
+                            for t, value, time in zip(types.tolist(),
+                                                      values.tolist(),
+                                                      times.tolist())]
+        return self._events
+
+    def decoded(self):
+        if self._decoded is None:
+            self._decoded = Event_Seqce.decode_array(self.conv2array())
+        return self._decoded
     
     def conv2note_seq(self):
-        time = 0
         notes = []
         
         velocity = STATE_VELOCITY
@@ -152,28 +227,27 @@ class Event_Seqce:
 
         last_notes = {}
 
-        for event in self.events:
-            if event.type == 'note_on':
-                pitch = event.value + Event_Seqce.pitch_range.start
+        types, values, times = self.decoded()
+        for event_type, value, time in zip(types.tolist(), values.tolist(),
+                                           times.tolist()):
+            if event_type == EVENT_NOTE_ON:
+                pitch = value + Event_Seqce.pitch_range.start
                 note = Note(velocity, pitch, time, None)
                 notes.append(note)
                 last_notes[pitch] = note
 
-            elif event.type == 'note_off':
-                pitch = event.value + Event_Seqce.pitch_range.start
+            elif event_type == EVENT_NOTE_OFF:
+                pitch = value + Event_Seqce.pitch_range.start
 
                 if pitch in last_notes:
                     note = last_notes[pitch]
                     note.end = max(time, note.start + MIN_NOTE_LENGTH)
                     del last_notes[pitch]
             
-            elif event.type == 'velocity':
-                index = min(event.value, velocity_bins.size - 1)
+            elif event_type == EVENT_VELOCITY:
+                index = min(value, velocity_bins.size - 1)
                 velocity = velocity_bins[index]
 
-            elif event.type == 'time_shift':
-                time += Event_Seqce.time_shift_bins[event.value]
-
         for note in notes:
             if note.end is None:
                 note.end = note.start + STATE_NOTE_LENGTH
@@ -183,11 +257,26 @@ class Event_Seqce:
         return Note_Seqce(notes)
 
     def conv2array(self):
+        if self._indeces is not None:
+            return self._indeces
         feat_idxs = Event_Seqce.featur_ranges()
         idxs = [feat_idxs[event.type][event.value] for event in self.events]
         dtype = np.uint8 if Event_Seqce.dim() <= 256 else np.uint16
         return np.array(idxs, dtype=dtype)
 
+# Vocabulary lookup tables, built once: event index -> type id, value
+# and the time shift (in seconds) it contributes.
+EVENT_TYPES = list(Event_Seqce.featur_ranges().keys())
+EVENT_NOTE_ON, EVENT_NOTE_OFF, EVENT_VELOCITY, EVENT_TIME_SHIFT = range(4)
+EVENT_TYPE_TABLE = np.concatenate([
+    np.full(len(feat_range), i, dtype=np.int64)
+    for i, feat_range in enumerate(Event_Seqce.featur_ranges().values())])
+EVENT_VALUE_TABLE = np.concatenate([
+    np.arange(len(feat_range), dtype=np.int64)
+    for feat_range in Event_Seqce.featur_ranges().values()])
+EVENT_SHIFT_TABLE = np.zeros(Event_Seqce.dim())
+EVENT_SHIFT_TABLE[Event_Seqce.featur_ranges()['time_shift']] = STATE_TIME_SHIFT_BINS
+
 class Control:
 
     def __init__(self, pitch_histogram, note_density):
@@ -233,16 +322,73 @@ class ControlSeq:
         return featur_ranges
     
     @staticmethod
-    def recover_compressed_array(array):
+    def recover_compressed_array(array, dtype=np.float64):
         featur_dimen = ControlSeq.featur_dimen()
-        ndens = np.zeros([array.shape[0], featur_dimen['note_density']])
-        ndens[np.arange(array.shape[0]), array[:, 0]] = 1. # [steps, dens_dim]
-        phist = array[:, 1:].astype(np.float64) / 255 # [steps, hist_dim]
-        return np.concatenate([ndens, phist], 1) # [steps, dens_dim + hist_dim]
+        ndens = np.eye(featur_dimen['note_density'], dtype=dtype)
+        ndens = ndens[array[..., 0]] # [..., dens_dim]
+        phist = array[..., 1:].astype(dtype) / 255 # [..., hist_dim]
+        return np.concatenate([ndens, phist], -1) # [..., dens_dim + hist_dim]
+
+    @staticmethod
+    def window_features(event_seq):
+        # For every event, the notes starting in the window_size seconds
+        # from it, the event itself included -> pitch histograms [steps, 12]
+        # and note density bins [steps]; counted with prefix sums
+        types, values, times = event_seq.decoded()
+        steps = types.size
+        is_on = types == EVENT_NOTE_ON
+        rel_pitch = (values + Event_Seqce.pitch_range.start - 24) % 12
+        counts = np.zeros([steps + 1, 12])
+        counts[np.flatnonzero(is_on) + 1, rel_pitch[is_on]] = 1.
+        np.cumsum(counts, 0, out=counts)
+
+        # window end: first event more than window_size after, compared
+        # as time - start like the event loop did, so rounding agrees
+        window = ControlSeq.window_size
+        index = np.arange(steps)
+        ends = np.searchsorted(times, times + window, side='right')
+        while True:
+            grow = ends < steps
+            grow[grow] = times[ends[grow]] - times[grow] <= window
+            shrink = ends - 1 > index
+            shrink[shrink] = times[ends[shrink] - 1] - times[shrink] > window
+            if not (grow.any() or shrink.any()):
+                break
+            ends += grow.astype(np.int64) - shrink
+
+        pitch_count = counts[ends] - counts[:-1]
+        note_count = pitch_count.sum(1)
+        pitch_histogram = np.full([steps, 12], 1. / 12)
+        has_notes = note_count > 0
+        pitch_histogram[has_notes] = pitch_count[has_notes] \
+                                     / note_count[has_notes, None]
+        note_density = np.maximum(np.searchsorted(ControlSeq.note_density_bins,
+                                                  note_count, side='right') - 1, 0)
+        return pitch_histogram, note_density
+
+    @staticmethod
+    def take_from_event_seq(event_seq):
+        pitch_histogram, note_density = ControlSeq.window_features(event_seq)
+        return ControlSeq([Control(hist, density) for hist, density
+                           in zip(pitch_histogram.tolist(), note_density.tolist())])
+
+    @staticmethod
+    def take_compressed_from_event_seq(event_seq):
+        # same as take_from_event_seq(event_seq).conv2compressed_array()
+        pitch_histogram, note_density = ControlSeq.window_features(event_seq)
+        ndens = note_density.astype(np.uint8).reshape(-1, 1) # [steps, 1]
+        phist = (pitch_histogram * 255).astype(np.uint8) # [steps, hist_dim]
+        return np.concatenate([ndens, phist], 1) # [steps, hist_dim + 1]
 
     def __init__(self, controls):
-        for control in controls:
-            self.controls = copy.deepcopy(controls)
+        self.controls = copy.deepcopy(controls)
+
+    def conv2compressed_array(self):
+        ndens = [control.note_density for control in self.controls]
+        ndens = np.array(ndens, dtype=np.uint8).reshape(-1, 1) # [steps, 1]
+        phist = [control.pitch_histogram for control in self.controls]
+        phist = (np.array(phist) * 255).astype(np.uint8) # [steps, hist_dim]
+        return np.concatenate([ndens, phist], 1) # [steps, hist_dim + 1]
 
 
 import os
@@ -262,13 +408,105 @@ def search_files(root, exts=[]):
             if _has_ext(name):
                 yield os.path.join(path, name)
 
+def event_indec2note_arrays(decoded, velocity_scale=0.8):
+    # (types, values, times) of one sequence -> pitches, velocities, starts, ends
+    types, values, times = decoded
+    is_on = types == EVENT_NOTE_ON
+    is_off = types == EVENT_NOTE_OFF
+
+    # velocity in effect at each event: last velocity event before it
+    velocity_bins = Event_Seqce.getting_veloc_basket()
+    is_velocity = types == EVENT_VELOCITY
+    last = np.where(is_velocity, np.arange(types.size), -1)
+    last = np.maximum.accumulate(last) if last.size else last
+    velocities = np.where(
+        last >= 0,
+        velocity_bins[np.minimum(values[np.maximum(last, 0)],
+                                 velocity_bins.size - 1)],
+        STATE_VELOCITY)
+
+    # a note_off closes the note_on right before it with the same pitch,
+    # any other note_on/note_off in between leaves the note open
+    positions = np.flatnonzero(is_on | is_off)
+    pitch_order = positions[np.lexsort((positions, values[positions]))]
+    closes = (is_on[pitch_order[:-1]] & is_off[pitch_order[1:]]
+              & (values[pitch_order[:-1]] == values[pitch_order[1:]]))
+    ends = np.full(types.size, np.nan)
+    ends[pitch_order[:-1][closes]] = times[pitch_order[1:][closes]]
+
+    on = np.flatnonzero(is_on)
+    pitches = values[on] + Event_Seqce.pitch_range.start
+    starts = times[on]
+    ends = ends[on]
+    ends = np.where(np.isnan(ends), starts + STATE_NOTE_LENGTH,
+                    np.maximum(ends, starts + MIN_NOTE_LENGTH))
+    velocities = velocities[on].astype(np.int64)
+    velocities = ((velocities - 64) * velocity_scale + 64).astype(np.int64)
+    return pitches, velocities, starts, ends
+
+
+def _smf_varlen(values):
+    # variable-length quantities, [n] ints -> [n, 4] bytes and a mask
+    shifts = np.array([21, 14, 7, 0])
+    lengths = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    data = (values[:, None] >> shifts) & 0x7f
+    data[:, :3] |= 0x80
+    mask = np.arange(4) >= 4 - lengths[:, None]
+    return data, mask
+
+
+def note_arrays2smf(pitches, velocities, starts, ends):
+    # Same layout Note_Seqce.convert2midi().write() produces: a tempo
+    # track and one piano track, note offs as velocity-0 note ons.
+    tick_scale = 60.0 / (STATE_TEMP * STATE_RESOLUTION)
+    n = pitches.size
+    ticks = np.rint(np.concatenate([starts, ends]) / tick_scale).astype(np.int64)
+    notes = np.concatenate([pitches, pitches]).astype(np.int64)
+    vels = np.concatenate([velocities, np.zeros(n, np.int64)])
+    order = np.lexsort((vels, notes, ticks))
+    ticks, notes, vels = ticks[order], notes[order], vels[order]
+
+    deltas = np.diff(ticks, prepend=0)
+    data, mask = _smf_varlen(deltas)
+    status = np.zeros([2 * n, 1], np.int64)
+    status[:1] = 0x90
+    data = np.concatenate([data, status, notes[:, None], vels[:, None]], 1)
+    mask = np.concatenate([mask, status > 0, np.ones([2 * n, 2], bool)], 1)
+    body = data[mask].astype(np.uint8).tobytes()
+
+    tempo = int(6e7 / STATE_TEMP)
+    name = b'Note_Seqce'
+    tempo_track = (b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big')
+                   + b'\x00\xff\x58\x04\x04\x02\x18\x08'
+                   + b'\x01\xff\x2f\x00')
+    note_track = (b'\x00\xff\x03' + bytes([len(name)]) + name
+                  + b'\x00\xc0\x01' + body + b'\x01\xff\x2f\x00')
+
+    chunks = [b'MThd' + struct.pack('>Ihhh', 6, 1, 2, STATE_RESOLUTION)]
+    for track in [tempo_track, note_track]:
+        chunks.append(b'MTrk' + struct.pack('>I', len(track)) + track)
+    return b''.join(chunks)
+
+
 def event_indec2midi_file(event_indeces, midi_file_name, velocity_scale=0.8):
-    event_seq = Event_Seqce.take_from_array(event_indeces)
-    note_seq = event_seq.conv2note_seq()
-    for note in note_seq.notes:
-        note.velocity = int((note.velocity - 64) * velocity_scale + 64)
-    note_seq.convert2midi_file(midi_file_name)
-    return len(note_seq.notes)
+    decoded = Event_Seqce.decode_array(event_indeces)
+    notes = event_indec2note_arrays(decoded, velocity_scale)
+    with open(midi_file_name, 'wb') as f:
+        f.write(note_arrays2smf(*notes))
+    return notes[0].size
+
+
+def event_indec2midi_files(event_indeces, midi_file_names, velocity_scale=0.8):
+    # [batch, steps] -> one file per row, decoded in one pass
+    types, values, times = Event_Seqce.decode_array(event_indeces)
+    n_notes = []
+    for i, midi_file_name in enumerate(midi_file_names):
+        decoded = (types[i], values[i], times[i])
+        notes = event_indec2note_arrays(decoded, velocity_scale)
+        with open(midi_file_name, 'wb') as f:
+            f.write(note_arrays2smf(*notes))
+        n_notes.append(notes[0].size)
+    return n_notes
 
 def grad_norm(parameters, norm_type=2):
     total_norm = 0
@@ -293,49 +531,472 @@ def params2dict(p, f=',', e='='):
     return d
 
 class Work_w_Dataset:
+    # Samples live in three flat arrays: events [total], compressed
+    # controls [total, 13] (both uint8) and offsets [samples + 1].
+    # A packed dataset (see preprocess.py -p) is memory-mapped, so it is
+    # not read at startup and the page cache is shared between processes;
+    # otherwise the .data files are loaded and concatenated.
+    packed_files = ('events.npy', 'controls.npy', 'offsets.npy')
+
     def __init__(self, root, verbose=False):
         assert os.path.isdir(root), root
-        paths = search_files(root, ['.data'])
         self.root = root
-        self.samples = []
-        self.seqlens = []
+        packed = Work_w_Dataset.is_packed(root)
+        if packed and Work_w_Dataset.pack_is_stale(root):
+            print(f'Warning: the packed dataset in "{root}" is out of date '
+                  f'with its .data files, reading those instead; run '
+                  f'preprocess.py -p to repack')
+            packed = False
+        if packed:
+            self.events, self.controls, self.offsets = [
+                np.load(os.path.join(root, name), mmap_mode='r')
+                for name in Work_w_Dataset.packed_files]
+        else:
+            self._load_data_files(root, verbose)
+        self.seqlens = np.diff(self.offsets)
+        self.samples = [(self.events[start:stop], self.controls[start:stop])
+                        for start, stop in zip(self.offsets[:-1],
+                                               self.offsets[1:])]
+        self.avglen = np.mean(self.seqlens)
+        self.held_out = np.zeros(len(self.seqlens), dtype=bool)
+        self.epoch = 0
+
+    @staticmethod
+    def is_packed(root):
+        return all(os.path.isfile(os.path.join(root, name))
+                   for name in Work_w_Dataset.packed_files)
+
+    @staticmethod
+    def pack_is_stale(root):
+        # .data files added, removed or rewritten since the pack was made;
+        # offsets.npy is the last of the packed files written
+        offsets_path = os.path.join(root, 'offsets.npy')
+        packed_at = os.path.getmtime(offsets_path)
+        paths = list(search_files(root, ['.data']))
+        n_packed = len(np.load(offsets_path, mmap_mode='r')) - 1
+        return len(paths) != n_packed or \
+               any(os.path.getmtime(path) > packed_at for path in paths)
+
+    def _load_data_files(self, root, verbose):
+        paths = sorted(search_files(root, ['.data']))
         if verbose:
-            paths = Bar(root).iter(list(paths))
+            paths = Bar(root).iter(paths)
+        eventseqs, controlseqs = [], []
         for path in paths:
-            eventseq, controlseq = torch.load(path)
-            controlseq = ControlSeq.recover_compressed_array(controlseq)
+            # pickled numpy arrays, not weights
+            eventseq, controlseq = torch.load(path, weights_only=False)
             assert len(eventseq) == len(controlseq)
-            self.samples.append((eventseq, controlseq))
-            self.seqlens.append(len(eventseq))
-        self.avglen = np.mean(self.seqlens)
-    
-    def batches(self, batch_size, window_size, stride_size):
-        indeces = [(i, range(j, j + window_size))
-                   for i, seqlen in enumerate(self.seqlens)
-                   for j in range(0, seqlen - window_size, stride_size)]
-        while True:
-            eventseq_batch = []
-            controlseq_batch = []
-            n = 0
-            for ii in np.random.permutation(len(indeces)):
-                i, r = indeces[ii]
-                eventseq, controlseq = self.samples[i]
-                eventseq = eventseq[r.start:r.stop]
-                controlseq = controlseq[r.start:r.stop]
-                eventseq_batch.append(eventseq)
-                controlseq_batch.append(controlseq)
-                n += 1
-                if n == batch_size:
-                    yield (np.stack(eventseq_batch, axis=1),
-                           np.stack(controlseq_batch, axis=1))
-                    eventseq_batch.clear()
-                    controlseq_batch.clear()
-                    n = 0
+            eventseqs.append(eventseq)
+            controlseqs.append(controlseq)
+        self.offsets = np.cumsum([0] + [len(e) for e in eventseqs])
+        self.events = np.concatenate(eventseqs or [np.zeros([0], np.uint8)])
+        compressed_dim = 1 + ControlSeq.featur_dimen()['pitch_histogram']
+        self.controls = np.concatenate(
+            controlseqs or [np.zeros([0, compressed_dim], np.uint8)])
+
+    @staticmethod
+    def pack(root):
+        # .data files under root -> packed arrays next to them, so that
+        # pack_is_stale can compare the two
+        dataset = Work_w_Dataset.__new__(Work_w_Dataset)
+        dataset._load_data_files(root, verbose=False)
+        arrays = (dataset.events, dataset.controls, dataset.offsets)
+        for name, array in zip(Work_w_Dataset.packed_files, arrays):
+            path = os.path.join(root, name)
+            np.save(path + '.tmp.npy', array)
+            os.replace(path + '.tmp.npy', path)
+        return len(dataset.offsets) - 1
+
+    def valid_split(self, ratio):
+        # Holds out about ratio of the samples for validation -> their ids.
+        # A sample is picked by a checksum of its start and length, so it
+        # stays on the same side when the corpus grows or is reordered.
+        # Training batches leave held-out samples out from now on.
+        codes = np.array([zlib.crc32(self.events[start:start + 1024].tobytes(),
+                                     int(length))
+                          for start, length in zip(self.offsets[:-1],
+                                                   self.seqlens)], dtype=np.int64)
+        self.held_out = codes % 10000 < ratio * 10000
+        return np.flatnonzero(self.held_out)
+
+    def window_index(self, window_size, stride_size):
+        # every training window as (sample id, offset inside the sample)
+        seqlens = np.asarray(self.seqlens, dtype=np.int64)
+        counts = np.maximum(seqlens - window_size + stride_size - 1, 0) // stride_size
+        counts[self.held_out] = 0
+        sample_ids = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        offsets = (np.arange(counts.sum()) - first) * stride_size
+        return sample_ids, offsets.astype(np.int32)
+
+    def gather(self, starts, window_size):
+        # absolute window starts [batch] -> events [window, batch] and
+        # float32 controls [window, batch, control_dim]
+        index = np.arange(window_size)[:, None] + starts[None, :]
+        controls = ControlSeq.recover_compressed_array(self.controls[index],
+                                                       np.float32)
+        return self.events[index], controls
+
+    def batch_starts(self, batch_size, window_size, stride_size, epochs=None,
+                     rng=np.random, skip=0, shard=None):
+        # -> (epoch, absolute window starts [batch]), one permutation per epoch.
+        # skip leaves out the first batches to resume a run; rng must be in
+        # the state it had when the run started. shard=(rank, world_size)
+        # keeps every world_size-th window of the permutation, so ranks with
+        # identically seeded rngs get disjoint, equally long shards.
+        sample_ids, offsets = self.window_index(window_size, stride_size)
+        starts = self.offsets[sample_ids] + offsets
+        epoch_iter = itertools.count() if epochs is None else range(epochs)
+        for epoch in epoch_iter:
+            order = rng.permutation(len(starts))
+            if shard is not None:
+                rank, world_size = shard
+                order = order[:len(order) - len(order) % world_size]
+                order = order[rank::world_size]
+            for i in range(0, len(order) - batch_size + 1, batch_size):
+                if skip:
+                    skip -= 1
+                    continue
+                yield epoch, starts[order[i:i + batch_size]]
+
+    def batches(self, batch_size, window_size, stride_size, epochs=None,
+                rng=np.random, skip=0, shard=None):
+        # self.epoch tells which pass over the windows a batch belongs to
+        for epoch, starts in self.batch_starts(batch_size, window_size,
+                                               stride_size, epochs, rng, skip,
+                                               shard):
+            self.epoch = epoch
+            yield self.gather(starts, window_size)
     
+    def stateful_batch_starts(self, batch_size, window_size, epochs=None,
+                              rng=np.random, skip=0, shard=None):
+        # Truncated BPTT order: every batch row walks through one sample in
+        # consecutive, non-overlapping windows and moves on to the next
+        # sample when the current one runs out.
+        # -> (epoch, window starts [batch], resets [batch]); resets marks
+        # rows that start a new sample and need a fresh hidden state.
+        # shard=(rank, world_size) splits the samples as in batch_starts.
+        seqlens = np.asarray(self.seqlens)
+        usable = np.flatnonzero((seqlens >= window_size) & ~self.held_out)
+        assert len(usable) > 0, 'no sample is as long as window_size'
+        rank, world_size = shard or (0, 1)
+        assert len(usable) >= world_size, 'fewer usable samples than ranks'
+        epoch_iter = itertools.count() if epochs is None else range(epochs)
+        sample_queue = (
+            (epoch, sample_id)
+            for epoch in epoch_iter
+            for sample_id in rng.permutation(usable)[
+                :len(usable) - len(usable) % world_size][rank::world_size])
+        lane_epoch = np.zeros(batch_size, dtype=np.int64)
+        lane_sample = np.zeros(batch_size, dtype=np.int64)
+        lane_pos = np.zeros(batch_size, dtype=np.int64)
+        resets = np.ones(batch_size, dtype=bool)
+        try:
+            for b in range(batch_size):
+                lane_epoch[b], lane_sample[b] = next(sample_queue)
+            while True:
+                starts = self.offsets[lane_sample] + lane_pos
+                if skip:
+                    skip -= 1
+                else:
+                    yield lane_epoch.min(), starts, resets.copy()
+                lane_pos += window_size
+                resets = lane_pos + window_size > seqlens[lane_sample]
+                for b in np.flatnonzero(resets):
+                    lane_epoch[b], lane_sample[b] = next(sample_queue)
+                    lane_pos[b] = 0
+        except StopIteration:
+            return
+
+    def stateful_batches(self, batch_size, window_size, epochs=None,
+                         rng=np.random, skip=0, shard=None):
+        for epoch, starts, resets in self.stateful_batch_starts(
+                batch_size, window_size, epochs, rng, skip, shard):
+            self.epoch = epoch
+            yield self.gather(starts, window_size) + (resets,)
+
     def __repr__(self):
         return (f'Work_w_Dataset(root="{self.root}", '
                 f'samples={len(self.samples)}, '
                 f'avglen={self.avglen})')
+def _put(q, item, stop):
+    # q.put that gives up once stop is set -> whether the item went in
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    # q.get that gives up once stop is set (-> None, like the end marker)
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def _prefetch_worker(dataset, window_size, tasks, results, stop):
+    while True:
+        task = _get(tasks, stop)
+        if task is None:
+            _put(results, None, stop)
+            return
+        epoch, starts, *extra = task
+        events, controls = dataset.gather(starts, window_size)
+        if not _put(results, (epoch, events.astype(np.int64), controls,
+                              *extra), stop):
+            return
+
+
+class Batch_Prefetcher:
+    # Builds ready-to-use (events, controls) tensors for the next batches
+    # in background threads or processes. Job i always goes to worker
+    # i % workers and is read back in the same order, so the batch
+    # sequence only depends on batch_starts, not on timing. close() (or
+    # leaving a with block) stops and joins the workers.
+
+    def __init__(self, dataset, batch_starts, window_size, depth=4, workers=1,
+                 processes=False):
+        if processes:
+            import torch.multiprocessing as mp
+            Queue, Worker, Event = mp.Queue, mp.Process, mp.Event
+        else:
+            Queue, Worker, Event = queue.Queue, threading.Thread, threading.Event
+        self.dataset = dataset
+        self.workers = workers
+        self.processes = processes
+        self.stop = Event()
+        per_worker = max(1, -(-depth // workers))
+        self.tasks = [Queue(per_worker) for _ in range(workers)]
+        self.results = [Queue(per_worker) for _ in range(workers)]
+        self.procs = [Worker(target=_prefetch_worker,
+                             args=(dataset, window_size, tasks, results,
+                                   self.stop),
+                             daemon=True)
+                      for tasks, results in zip(self.tasks, self.results)]
+        for proc in self.procs:
+            proc.start()
+        self.feeder = threading.Thread(target=self._feed, args=(batch_starts,),
+                                       daemon=True)
+        self.feeder.start()
+
+    def _feed(self, batch_starts):
+        for i, task in enumerate(batch_starts):
+            if not _put(self.tasks[i % self.workers], task, self.stop):
+                return
+        for tasks in self.tasks:
+            _put(tasks, None, self.stop)
+
+    def __iter__(self):
+        for i in itertools.count():
+            item = self.results[i % self.workers].get()
+            if item is None:
+                return
+            self.dataset.epoch, events, controls, *extra = item
+            yield (torch.from_numpy(events), torch.from_numpy(controls),
+                   *extra)
+
+    def close(self):
+        self.stop.set()
+        self.feeder.join()
+        for proc in self.procs:
+            proc.join(1.0)
+            if self.processes and proc.is_alive():
+                proc.terminate()
+                proc.join()
+        if self.processes:
+            # don't wait at exit to flush batches nobody will read
+            for q in self.tasks + self.results:
+                q.cancel_join_thread()
+                q.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def snapshot(obj):
+    # copy of a (nested) state dict that training can't change under us
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def get_np_state(rng):
+    # numpy RandomState state with the key as a tensor, so checkpoints load
+    # with torch.load's defaults
+    name, keys, pos, has_gauss, gauss = rng.get_state()
+    return name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, gauss
+
+
+def set_np_state(rng, state):
+    name, keys, pos, has_gauss, gauss = state
+    rng.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss,
+                   gauss))
+
+
+class Checkpointer:
+    # Writes checkpoints in a background thread. Each one goes to a
+    # temporary file that is renamed over sess_path, so the file on disk is
+    # always a complete checkpoint; the previous `keep` ones stay as
+    # sess_path.1 (newest) .. sess_path.<keep>.
+
+    def __init__(self, sess_path, keep=2):
+        self.sess_path = sess_path
+        self.keep = keep
+        self.thread = None
+        self.error = None
+
+    def backups(self):
+        return [f'{self.sess_path}.{i}' for i in range(1, self.keep + 1)]
+
+    def _rotate(self):
+        if not self.keep or not os.path.isfile(self.sess_path):
+            return
+        backups = self.backups()
+        for older, newer in zip(backups[::-1], backups[-2::-1]):
+            if os.path.isfile(newer):
+                os.replace(newer, older)
+        if os.path.isfile(backups[0]):
+            os.remove(backups[0])
+        try:
+            os.link(self.sess_path, backups[0])
+        except OSError:
+            shutil.copy2(self.sess_path, backups[0])
+
+    def _write(self, state):
+        try:
+            tmp_path = self.sess_path + '.tmp'
+            torch.save(state, tmp_path)
+            self._rotate()
+            os.replace(tmp_path, self.sess_path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, block=False):
+        # state should be a snapshot(); waits for the previous write first
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state,))
+        self.thread.start()
+        if block:
+            self.wait()
+
+
+def init_distributed():
+    # rank and world size from the env:// variables torchrun sets
+    dist.init_process_group('gloo')
+    return dist.get_rank(), dist.get_world_size()
+
+
+def broadcast_model(model):
+    # every rank starts from rank 0's weights
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+def broadcast_object(obj):
+    # rank 0's obj on every rank (pickled, tensors included)
+    objects = [obj]
+    dist.broadcast_object_list(objects, 0)
+    return objects[0]
+
+
+def all_reduce_grads(model, loss):
+    # Averages the gradients over all ranks in a single all_reduce, with
+    # the loss riding along at the end -> mean loss over ranks
+    params = list(model.parameters())
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    flat = torch.cat([p.grad.view(-1) for p in params] +
+                     [loss.detach().float().view(1)])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for p in params:
+        p.grad.copy_(flat[offset:offset + p.numel()].view_as(p))
+        offset += p.numel()
+    return flat[-1].item()
+
+
+def evaluate(model, dataset, sample_ids, batch_size=256, window_size=200,
+             carry=False, max_events=0):
+    # Teacher-forced cross-entropy of every event of the given samples
+    # -> (mean nats per event, number of events). By default the samples
+    # are cut into non-overlapping windows, each read from a fresh hidden
+    # state like a training window, and the windows go through in large
+    # batches. carry=True reads every sample from its start, carrying the
+    # hidden state from window to window (slower, far fewer rows).
+    # max_events caps the windows read to about that many events, spread
+    # evenly over the samples and the same ones on every call, so losses
+    # from different iterations compare.
+    was_training = model.training
+    model.eval()
+    sample_ids = np.asarray(sample_ids)
+    lengths = dataset.seqlens[sample_ids]
+    if carry:
+        order = np.argsort(lengths, kind='stable')  # less padding
+        row_starts = dataset.offsets[sample_ids][order]
+        row_lengths = lengths[order]
+    else:
+        windows = -(-lengths // window_size)
+        first = np.repeat(np.cumsum(windows) - windows, windows)
+        position = (np.arange(windows.sum()) - first) * window_size
+        row_starts = np.repeat(dataset.offsets[sample_ids], windows) + position
+        row_lengths = np.minimum(np.repeat(lengths, windows) - position,
+                                 window_size)
+        n_windows = -(-max_events // window_size)
+        if max_events and n_windows < len(row_starts):
+            picked = np.unique(np.linspace(0, len(row_starts) - 1,
+                                           n_windows).round().astype(np.int64))
+            row_starts, row_lengths = row_starts[picked], row_lengths[picked]
+    total, count = 0., 0
+    with torch.no_grad():
+        for i in range(0, len(row_starts), batch_size):
+            starts = row_starts[i:i + batch_size]
+            lengths = row_lengths[i:i + batch_size]
+            init = torch.zeros(len(starts), model.init_dim).to(device)
+            hidden = model.initialise2hidden(init)
+            prev = model.simple_event(len(starts))
+            for t0 in range(0, lengths.max(), window_size):
+                steps = np.arange(t0, min(t0 + window_size, lengths.max()))
+                # finished rows repeat their last event, masked out below
+                index = starts + np.minimum(steps[:, None], lengths - 1)
+                events = torch.from_numpy(
+                    dataset.events[index].astype(np.int64)).to(device)
+                controls = torch.from_numpy(ControlSeq.recover_compressed_array(
+                    dataset.controls[index], np.float32)).to(device)
+                inputs = torch.cat([prev, events[:-1]], 0)
+                logits, hidden = model.forw_teacher_forced(inputs, controls,
+                                                           hidden)
+                loss = F.cross_entropy(logits.view(-1, model.event_dim),
+                                       events.view(-1), reduction='none')
+                mask = torch.from_numpy(steps[:, None] < lengths).to(device)
+                total += loss.view(events.shape)[mask].sum().item()
+                count += int(mask.sum())
+                prev = events[-1:]
+    model.train(was_training)
+    return total / max(count, 1), count
+
 ## Config
 
 import torch
@@ -363,6 +1024,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import Categorical
+from torch.func import functional_call
+import torch.distributed as dist
 
 import numpy as np
 from progress.bar import Bar
@@ -389,6 +1052,7 @@ class Model_RNN(nn.Module):
                           num_layers=gru_layers, dropout=gru_dropout)
         self.output_fc = nn.Linear(hidden_dim * gru_layers, self.output_dim)
         self.output_fc_activation = nn.Softmax(dim=-1)
+        self._gru_layer = None
 
         self._init_weights()
     
@@ -428,6 +1092,59 @@ class Model_RNN(nn.Module):
         output = self.output_fc(output)
         return output, hidden
     
+    def forw_teacher_forced(self, events, controls=None, hidden=None):
+        # Same logits as calling forw step by step on events [steps, batch],
+        # but each GRU layer runs over the whole window in one call.
+        steps, batch_size = events.shape
+        event = self.event_embedding(events)
+
+        if controls is None:
+            default = torch.ones(steps, batch_size, 1).to(device)
+            controls = torch.zeros(steps, batch_size, self.control_dim).to(device)
+        else:
+            default = torch.zeros(steps, batch_size, 1).to(device)
+
+        concat = torch.cat([event, default, controls], -1)
+        input = self.concat_input_fc(concat)
+        input = self.concat_input_fc_activation(input)
+
+        if self._gru_layer is None:
+            # unregistered single-layer template, runs with self.gru's weights
+            self.__dict__['_gru_layer'] = nn.GRU(self.input_dim, self.hidden_dim,
+                                                 device='meta')
+        states, last = [], []
+        for layer in range(self.gru_layers):
+            params = {f'{name}_l0': getattr(self.gru, f'{name}_l{layer}')
+                      for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh')}
+            layer_hidden = hidden[layer:layer + 1] if hidden is not None else None
+            output, layer_hidden = functional_call(self._gru_layer, params,
+                                                   (input, layer_hidden))
+            states.append(output)
+            last.append(layer_hidden)
+            input = output
+            if layer < self.gru_layers - 1:
+                input = F.dropout(output, self.gru.dropout, self.training)
+
+        output = self.output_fc(torch.cat(states, -1))
+        return output, torch.cat(last, 0)
+
+    def forw_carried(self, init, events, controls=None, hidden=None,
+                     prev_event=None, resets=None):
+        # One truncated-BPTT window: rows flagged in resets start from init
+        # and simple_event, the others continue from the detached hidden
+        # state and the last event of their previous window.
+        batch_size = events.shape[1]
+        first = self.simple_event(batch_size)
+        fresh = self.initialise2hidden(init)
+        if hidden is None:
+            hidden = fresh
+        else:
+            resets = torch.as_tensor(resets, device=device)
+            hidden = torch.where(resets[None, :, None], fresh, hidden.detach())
+            first = torch.where(resets[None], first, prev_event[None])
+        events = torch.cat([first, events[:-1]], 0)
+        return self.forw_teacher_forced(events, controls, hidden)
+
     def simple_event(self, batch_size):
         return torch.LongTensor([[self.primary_event] * batch_size]).to(device)
     
@@ -458,6 +1175,11 @@ class Model_RNN(nn.Module):
             controls = self.expand_contr(controls, steps)
         hidden = self.initialise2hidden(init)
 
+        if use_teacher_forcing and teacher_forcing_ratio >= 1.0:
+            events = torch.cat([event, events], 0)
+            output, _ = self.forw_teacher_forced(events, controls, hidden)
+            return output
+
         outputs = []
         step_iter = range(steps)
 
@@ -500,49 +1222,154 @@ def get_options():
                       type='int',
                       default=train['window_size'])
 
-    return parser.parse_args()[0]
+    parser.add_option('--seed',
+                      dest='seed',
+                      type='int',
+                      default=None)
 
-options = get_options()
+    parser.add_option('--prefetch',
+                      dest='prefetch',
+                      type='int',
+                      default=0,
+                      help='batches to prepare in the background (0 = off)')
+
+    parser.add_option('--workers',
+                      dest='workers',
+                      type='int',
+                      default=1)
+
+    parser.add_option('--processes',
+                      dest='processes',
+                      action='store_true',
+                      default=False,
+                      help='prefetch in processes instead of threads')
+
+    parser.add_option('--stateful',
+                      dest='stateful',
+                      action='store_true',
+                      default=False,
+                      help='truncated BPTT over consecutive windows, '
+                           'hidden state carried between batches')
+
+    parser.add_option('--verbose', '--report-wait',
+                      dest='verbose',
+                      action='store_true',
+                      default=False,
+                      help='also print the loss and the time spent waiting '
+                           'for batches every iteration')
+
+    parser.add_option('--bf16',
+                      dest='bf16',
+                      action='store_true',
+                      default=False,
+                      help='bfloat16 autocast for the forward pass, '
+                           'weights and optimizer stay fp32')
+
+    parser.add_option('--distributed',
+                      dest='distributed',
+                      action='store_true',
+                      default=False,
+                      help='data parallel over torch.distributed (gloo), '
+                           'start with torchrun; -b is the batch per rank')
+
+    parser.add_option('--valid-ratio',
+                      dest='valid_ratio',
+                      type='float',
+                      default=0.0,
+                      help='share of samples held out for validation')
+
+    parser.add_option('--valid-every',
+                      dest='valid_every',
+                      type='int',
+                      default=500,
+                      help='iterations between validation runs')
+
+    parser.add_option('--valid-batch',
+                      dest='valid_batch',
+                      type='int',
+                      default=256)
+
+    parser.add_option('--valid-events',
+                      dest='valid_events',
+                      type='int',
+                      default=20000,
+                      help='events read per validation run, a fixed subset '
+                           'of the split (0 = all)')
+
+    parser.add_option('--keep',
+                      dest='keep',
+                      type='int',
+                      default=2,
+                      help='previous checkpoints to keep as <sess>.1, <sess>.2...')
+
+    parser.add_option('--log',
+                      dest='log_path',
+                      type='string',
+                      default=None,
+                      help='append phase timings and speed as json lines here')
+
+    parser.add_option('--log-every',
+                      dest='log_every',
+                      type='int',
+                      default=100,
+                      help='iterations per timing summary')
+
+    parser.add_option('--profile',
+                      dest='profile',
+                      type='string',
+                      default=None,
+                      help='A:B, trace iterations A to B-1 with torch.profiler')
+
+    parser.add_option('--trace',
+                      dest='trace_path',
+                      type='string',
+                      default='trace.json',
+                      help='chrome trace file for --profile')
+
+    return parser.parse_args()[0]
 
 #------------------------------------------------------------------------
 
-sess_path = options.sess_path
-data_path = options.data_path
 saving_interval = 60
 
-learning_rate = train['learning_rate']
-batch_size = options.batch_size
-window_size = options.window_size
-stride_size = train['stride_size']
-control_ratio = train['control_ratio']
-teacher_forcing_ratio = train['teacher_forcing_ratio']
-
 event_dim = Event_Seqce.dim()
 control_dim = ControlSeq.dim()
 model_config = model
-device = device
 
-def prep_sess():
-    global sess_path, model_config, device, learning_rate
-    try:
-        sess = torch.load(sess_path)
+def prep_sess(distributed=False):
+    # -> model, optimizer and the saved train_state (None for a new run);
+    # falls back to the kept backups if sess_path can't be read. With
+    # distributed only rank 0 reads it and sends the whole session to the
+    # others, so every rank resumes with the same weights, optimizer state
+    # and train_state whatever its own copy of sess_path holds
+    global sess_path, model_config, device, learning_rate, checkpointer
+    sess = path = None
+    if not distributed or dist.get_rank() == 0:
+        for path in [sess_path] + checkpointer.backups():
+            if not os.path.isfile(path):
+                continue
+            try:
+                sess = torch.load(path, map_location='cpu')
+                break
+            except Exception as e:
+                print('Could not load', path, repr(e))
+    if distributed:
+        sess, path = broadcast_object((sess, path))
+    if sess is None:
+        print('New session')
+    else:
         if 'model_config' in sess and sess['model_config'] != model_config:
             model_config = sess['model_config']
             print('Use session config instead:')
-            print(utils.dict2params(model_config))
-        model_state = sess['model_state']
-        optimizer_state = sess['model_optimizer_state']
-        print('Session is loaded from', sess_path)
-        sess_loaded = True
-    except:
-        print('New session')
-        sess_loaded = False
+            print(model_config)
+        print('Session is loaded from', path)
     model = Model_RNN(**model_config).to(device)
     optimizer = optim.Adam(model.parameters(), lr=learning_rate)
-    if sess_loaded:
-        model.load_state_dict(model_state)
-        optimizer.load_state_dict(optimizer_state)
-    return model, optimizer
+    if sess is None:
+        return model, optimizer, None
+    model.load_state_dict(sess['model_state'])
+    optimizer.load_state_dict(sess['model_optimizer_state'])
+    return model, optimizer, sess.get('train_state')
 
 def load_dataset():
     global data_path
@@ -551,67 +1378,261 @@ def load_dataset():
     assert dataset_size > 0
     return dataset
 
-
-print('Loading session')
-model, optimizer = prep_sess()
-print(model)
-
-print('-' * 70)
-
-print('Loading dataset')
-dataset = load_dataset()
-print(dataset)
-
-print('-' * 70)
-
-#------------------------------------------------------------------------
-
-def save_model():
-    global model, optimizer, model_config, sess_path
+def save_model(train_state=None, block=False):
+    # snapshots the state here, the file is written in the background
+    global model, optimizer, model_config, sess_path, checkpointer
     print('Saving to', sess_path)
-    torch.save({'model_config': model_config,
-                'model_state': model.state_dict(),
-                'model_optimizer_state': optimizer.state_dict()}, sess_path)
-    print('Done saving')
-
-
-
-last_saving_time = time.time()
-loss_function = nn.CrossEntropyLoss()
-
-try:
-    batch_gen = dataset.batches(batch_size, window_size, stride_size)
+    state = snapshot({'model_config': model_config,
+                      'model_state': model.state_dict(),
+                      'model_optimizer_state': optimizer.state_dict()})
+    if train_state is not None:
+        state['train_state'] = snapshot(train_state)
+    checkpointer.save(state, block)
+    if block:
+        print('Done saving')
 
-    for iteration, (events, controls) in enumerate(batch_gen):
-
-        events = torch.LongTensor(events).to(device)
-        assert events.shape[0] == window_size
+#------------------------------------------------------------------------
 
-        if np.random.random() < control_ratio:
-            controls = torch.FloatTensor(controls).to(device)
-            assert controls.shape[0] == window_size
+if __name__ == '__main__':
+    options = get_options()
+
+    sess_path = options.sess_path
+    data_path = options.data_path
+
+    learning_rate = train['learning_rate']
+    batch_size = options.batch_size
+    window_size = options.window_size
+    stride_size = train['stride_size']
+    control_ratio = train['control_ratio']
+    teacher_forcing_ratio = train['teacher_forcing_ratio']
+
+    rank, world_size = init_distributed() if options.distributed else (0, 1)
+    shard = (rank, world_size) if options.distributed else None
+
+    if options.seed is not None:
+        np.random.seed(options.seed + rank)
+        torch.manual_seed(options.seed + rank)
+    # the data order has its own rng, so resuming can replay it; all ranks
+    # share its seed and take their shard of the same permutation
+    data_seed = options.seed
+    if options.distributed and data_seed is None:
+        data_seed = torch.randint(2**31, (1,))
+        dist.broadcast(data_seed, 0)
+        data_seed = int(data_seed)
+    data_rng = np.random.RandomState(data_seed)
+
+    checkpointer = Checkpointer(sess_path, options.keep)
+
+    print('Loading session')
+    model, optimizer, train_state = prep_sess(options.distributed)
+    if options.distributed:  # a new session starts from rank 0's init
+        broadcast_model(model)
+    print(model)
+
+    sampler = {'stateful': options.stateful, 'batch_size': batch_size,
+               'window_size': window_size, 'stride_size': stride_size,
+               'world_size': world_size, 'valid_ratio': options.valid_ratio}
+    sampler_rng = get_np_state(data_rng)
+    start_iteration = skip = 0
+    hidden = prev_event = None
+    if train_state is not None:
+        # the checkpoint holds rank 0's own rngs and carried hidden state,
+        # the other ranks go on with fresh ones
+        start_iteration = train_state['iteration']
+        if rank == 0:
+            set_np_state(np.random, train_state['np_rng'])
+            torch.set_rng_state(train_state['torch_rng'])
+        if train_state['sampler'] == sampler:
+            sampler_rng = train_state['sampler_rng']
+            set_np_state(data_rng, sampler_rng)
+            skip = train_state['sampler_position']
+            if rank == 0:
+                hidden = train_state['hidden']
+                prev_event = train_state['prev_event']
         else:
-            controls = None
-
-        init = torch.randn(batch_size, model.init_dim).to(device)
-        outputs = model.gen_samples(init, window_size, events=events[:-1], controls=controls,
-                                 teacher_forcing_ratio=teacher_forcing_ratio)
-        assert outputs.shape[:2] == events.shape[:2]
-
-        loss = loss_function(outputs.view(-1, event_dim), events.view(-1))
-        model.zero_grad()
-        loss.backward()
-
-        norm = grad_norm(model.parameters())
-        nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-        
-        optimizer.step()
-
-        print(f'iter {iteration}, loss: {loss.item()}')
-
-        if time.time() - last_saving_time > saving_interval:
-            save_model()
-            last_saving_time = time.time()
-
-except KeyboardInterrupt:
-    save_model()
+            print('Batch settings changed, data order starts over')
+        print(f'Resuming at iteration {start_iteration}')
+
+    print('-' * 70)
+
+    print('Loading dataset')
+    dataset = load_dataset()
+    print(dataset)
+    valid_ids = dataset.valid_split(options.valid_ratio)
+    if len(valid_ids):
+        print(f'Validation split: {len(valid_ids)} samples, '
+              f'{dataset.seqlens[valid_ids].sum()} events')
+
+    print('-' * 70)
+
+    last_saving_time = time.time()
+    loss_function = nn.CrossEntropyLoss()
+
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+    timer = Phase_Timer(sync)
+    metrics_log = Metrics_Log(options.log_path if rank == 0 else None)
+    window_losses = []
+    profiler = None
+    if options.profile:
+        profile_start, profile_stop = parse_range(options.profile)
+        profile_start = max(profile_start, start_iteration)
+        if profile_start < profile_stop:
+            trace_path = f'{options.trace_path}.{rank}' \
+                         if options.distributed else options.trace_path
+            profiler = make_profiler(trace_path, profile_start - start_iteration,
+                                     profile_stop - profile_start)
+            profiler.start()
+
+    prefetcher = None
+    try:
+        if options.stateful:
+            assert teacher_forcing_ratio >= 1.0, 'stateful mode is teacher forced'
+            batch_starts = dataset.stateful_batch_starts(batch_size, window_size,
+                                                         rng=data_rng, skip=skip,
+                                                         shard=shard)
+        else:
+            batch_starts = dataset.batch_starts(batch_size, window_size,
+                                                stride_size, rng=data_rng,
+                                                skip=skip, shard=shard)
+        if options.prefetch:
+            batch_gen = prefetcher = Batch_Prefetcher(
+                dataset, batch_starts, window_size, options.prefetch,
+                options.workers, options.processes)
+        elif options.stateful:
+            batch_gen = dataset.stateful_batches(batch_size, window_size,
+                                                 rng=data_rng, skip=skip,
+                                                 shard=shard)
+        else:
+            batch_gen = dataset.batches(batch_size, window_size, stride_size,
+                                        rng=data_rng, skip=skip, shard=shard)
+        data_wait = window_wait = 0.  # seconds, in all and at the window start
+        train_start = fetch_start = time.time()
+
+        for iteration, (events, controls, *resets) in enumerate(batch_gen,
+                                                               start_iteration):
+            data_wait += time.time() - fetch_start
+            timer.add('fetch', time.time() - fetch_start)
+
+            with timer.phase('to_tensor'):
+                events = torch.as_tensor(events, dtype=torch.long).to(device)
+                assert events.shape[0] == window_size
+
+                if np.random.random() < control_ratio:
+                    controls = torch.as_tensor(controls, dtype=torch.float32).to(device)
+                    assert controls.shape[0] == window_size
+                else:
+                    controls = None
+
+                init = torch.randn(batch_size, model.init_dim).to(device)
+            with timer.phase('forward'):
+                with torch.autocast(device.type, dtype=torch.bfloat16,
+                                    enabled=options.bf16):
+                    if options.stateful:
+                        outputs, hidden = model.forw_carried(
+                            init, events, controls, hidden, prev_event, resets[0])
+                        prev_event = events[-1]
+                    else:
+                        outputs = model.gen_samples(init, window_size, events=events[:-1], controls=controls,
+                                                 teacher_forcing_ratio=teacher_forcing_ratio)
+                assert outputs.shape[:2] == events.shape[:2]
+
+                # the loss is taken in fp32 whatever the forward ran in
+                loss = loss_function(outputs.float().view(-1, event_dim), events.view(-1))
+            with timer.phase('backward'):
+                model.zero_grad()
+                loss.backward()
+                loss_value = loss.item()
+                if options.distributed:
+                    loss_value = all_reduce_grads(model, loss)
+
+            with timer.phase('grad_norm'):
+                norm = grad_norm(model.parameters())
+                nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+
+            with timer.phase('optimizer'):
+                optimizer.step()
+
+            # everything needed to continue exactly after this iteration, taken
+            # right after the step so that a Ctrl-C during validation saves
+            # the new weights with their own state
+            train_state = {
+                'iteration': iteration + 1,
+                'sampler': sampler,
+                'sampler_rng': sampler_rng,
+                'sampler_position': skip + iteration + 1 - start_iteration,
+                'np_rng': get_np_state(np.random),
+                'torch_rng': torch.get_rng_state(),
+                'hidden': hidden,
+                'prev_event': prev_event,
+            }
+
+            window_losses.append(loss_value)
+
+            if options.verbose and rank == 0:
+                print(f'epoch {dataset.epoch}, iter {iteration}, loss: {loss_value}, '
+                      f'time: {time.time() - train_start:.1f}s, '
+                      f'waited for data: {data_wait:.3f}s total')
+
+            if (rank == 0 and len(valid_ids)
+                    and (iteration + 1) % options.valid_every == 0):
+                valid_start = time.time()
+                with timer.phase('validate'):
+                    valid_loss, n_events = evaluate(model, dataset, valid_ids,
+                                                    options.valid_batch, window_size,
+                                                    max_events=options.valid_events)
+                print(f'valid loss: {valid_loss:.4f}, '
+                      f'perplexity: {np.exp(valid_loss):.2f} '
+                      f'({n_events} events, {time.time() - valid_start:.1f}s)')
+
+            if rank == 0 and time.time() - last_saving_time > saving_interval:
+                with timer.phase('save'):
+                    save_model(train_state)
+                last_saving_time = time.time()
+
+            if profiler is not None:
+                profiler.step()
+                if iteration + 1 >= profile_stop:
+                    profiler.stop()
+                    profiler = None
+                    print('Trace saved to', trace_path)
+
+            if len(window_losses) == options.log_every:
+                report = timer.report()
+                n = len(window_losses)
+                record = {
+                    'iteration': iteration + 1,
+                    'epoch': dataset.epoch,
+                    'loss': float(np.mean(window_losses)),
+                    'data_wait': data_wait - window_wait,
+                    'data_wait_total': data_wait,
+                    'it_per_sec': n / report['wall'],
+                    'events_per_sec': n * batch_size * window_size
+                                      * world_size / report['wall'],
+                    'phases_ms': {name: phase['seconds'] / n * 1e3
+                                  for name, phase in report['phases'].items()},
+                    'peak_rss_mb': peak_rss_bytes() / 2**20,
+                }
+                metrics_log.write(record)
+                if rank == 0:
+                    print(f'epoch {dataset.epoch}, iter {iteration + 1}, '
+                          f'loss: {record["loss"]:.4f}, '
+                          f'time: {time.time() - train_start:.1f}s, '
+                          f'waited for data: {record["data_wait"]:.3f}s | '
+                          f'{record["it_per_sec"]:.2f} it/s, '
+                          f'{record["events_per_sec"]:.0f} events/s, '
+                          f'peak RSS {record["peak_rss_mb"]:.0f}MB | '
+                          + phase_summary(report, n))
+                window_losses = []
+                window_wait = data_wait
+
+            fetch_start = time.time()
+
+    except KeyboardInterrupt:
+        if profiler is not None:
+            profiler.stop()
+        metrics_log.close()
+        if rank == 0:
+            save_model(train_state, block=True)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()